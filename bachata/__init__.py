@@ -10,13 +10,15 @@ Overview
 - Requires Tornado running on asyncio event loop
 - Implements simple messages queue on Redis LPUSH / BRPOP
 - Implements reliable messages delivery on Redis BRPOPLPUSH pattern
-- JSON messages format
-- Custom messages routing
+- Implements in-process memory queue for single node deployments
+- JSON messages format, optional MessagePack format
+- Custom messages routing, groups fan-out
 
 """
 __version__ = '0.1.1'
 
 from .base import (
+    Group,
     BaseRoute,
     BaseQueue,
     BaseMessagesCenter,
@@ -24,16 +26,21 @@ from .base import (
 
 from .proto import (
     BaseProtocol,
+    MsgPackProtocol,
 )
 
 from .routes import (
     DirectRoute,
+    GroupRoute,
 )
 
 __all__ = (
+    'Group',
     'BaseRoute',
     'BaseQueue',
     'BaseMessagesCenter',
     'BaseProtocol',
+    'MsgPackProtocol',
     'DirectRoute',
+    'GroupRoute',
 )
@@ -3,6 +3,28 @@ import asyncio
 from  . import proto as base_proto
 
 
+class Group:
+    """Group of channels as route destination, message is delivered to
+    all group members, see :meth:`.BaseQueue.put_group_message`.
+
+    :param name: Group name
+
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Group) and (other.name == self.name)
+
+    def __hash__(self):
+        return hash((Group, self.name))
+
+    def __repr__(self):
+        return 'Group(%r)' % self.name
+
+
 class BaseRoute:
     """Base messages route class.
 
@@ -11,7 +33,20 @@ class BaseRoute:
     direct users messages, group chat messages, system
     notifications, etc.
 
+    Route may declare message types it handles in :attr:`.types`,
+    then it's processed only for messages of that types, routes
+    without declared types are processed for every message.
+
+    Route may be marked as :attr:`.concurrent`, if it doesn't depend
+    on other routes results and its side effects, then adjacent
+    concurrent routes are processed together, see
+    :meth:`.BaseMessagesCenter.process_routes`.
+
     """
+    types = None
+
+    concurrent = False
+
     @asyncio.coroutine
     def process(self, message, websocket=None, proto=None):
         """Process message and return receiver channel for the message.
@@ -22,12 +57,21 @@ class BaseRoute:
           router in chain.
         - If method returns non-empty channel string, then message will
           be sent to that channel.
+        - If method returns list or tuple of channels, then message will
+          be sent to all of them.
+        - If method returns :class:`.Group` instance, then message will
+          be sent to all group members.
         - If method returns ``True``, then routing chain should be stopped
           for this message.
 
+        Route may modify message, but values changed in place inside
+        nested fields must be followed by
+        :meth:`.Message.mark_changed` call.
+
         :param message: Arbitrary message object.
         :param proto: Messages protocol instance
-        :returns: String channel identifier or ``True`` or ``None``
+        :returns: String channel identifier, list of channels,
+                  :class:`.Group` or ``True`` or ``None``
 
         """
         raise NotImplementedError
@@ -36,6 +80,9 @@ class BaseRoute:
     def post_process(self, message, to_channel=None, queue=None):
         """Post process message after putting it on delivery queue.
 
+        Post processing is called for every destination returned by
+        route, i.e. for every channel or :class:`.Group`.
+
         Scenarios examples:
 
         - Test if message was delivered after certain timeout and
@@ -47,13 +94,24 @@ class BaseRoute:
 
 
 class BaseQueue:
-    """Base messages queue class."""
+    """Base messages queue class.
+
+    Messages for channel are delivered to all its WebSockets, so
+    delivery confirmations are tracked per WebSocket, see
+    :meth:`.confirm_delivered`.
+
+    """
+
+    GROUP_CHUNK = 1000
+
+    confirmations = None
 
     def add_socket(self, channel, websocket, proto=None):
         """Register WebSocket for receiving messages from channel.
 
-        Method implementation has to write 'ready' transport message
-        on success or close WebSocket connection.
+        Method implementation has to write 'ready' transport message with
+        ``websocket.write_transport()`` on success or close WebSocket
+        connection.
 
         :param channel: String channel identifier, based on user id or some
                         hash string
@@ -85,6 +143,60 @@ class BaseQueue:
         """
         raise NotImplementedError
 
+    @asyncio.coroutine
+    def put_group_message(self, group, message, proto=None,
+                          from_channel=None):
+        """Put message on queue for all group members.
+
+        Default implementation gets group members and puts message
+        for them by chunks of :attr:`.GROUP_CHUNK` channels, queue
+        implementations may redefine it to fan out on storage side.
+
+        :param group: :class:`.Group` instance or group name
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        members = list((yield from self.get_group_members(group)))
+        for i in range(0, len(members), self.GROUP_CHUNK):
+            if i:
+                # Let other tasks run between chunks
+                yield from asyncio.sleep(0)
+            yield from self.put_message(members[i:i + self.GROUP_CHUNK],
+                                        message, proto=proto,
+                                        from_channel=from_channel)
+
+    @asyncio.coroutine
+    def add_group_members(self, group, channels):
+        """Add channels to group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def del_group_members(self, group, channels):
+        """Remove channels from group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def get_group_members(self, group):
+        """Get group channels.
+
+        :param group: :class:`.Group` instance or group name
+        :return: Set of channels
+
+        """
+        raise NotImplementedError
+
     @asyncio.coroutine
     def check_delivered(self, channel, message_id):
         """Check if message is delivered.
@@ -94,6 +206,76 @@ class BaseQueue:
         """
         return True
 
+    def get_sockets(self, channel):
+        """Get WebSockets listening channel on this process.
+
+        Default implementation doesn't track WebSockets and returns
+        empty list.
+        """
+        return ()
+
+    def confirm_delivered(self, channel, message_ids, websocket):
+        """Register delivery confirmation from WebSocket and get IDs
+        of messages confirmed by all channel WebSockets, only such
+        messages should be popped, see :meth:`.pop_delivered`.
+
+        If WebSocket closes without confirmation, then message is not
+        popped and is sent again on next connection.
+
+        :param channel: Channel received messages
+        :param message_ids: List of messages IDs
+        :param websocket: WebSocket confirmed delivery
+        :return: List of messages IDs
+
+        """
+        websockets = self.get_sockets(channel)
+        confirmations = (self.confirmations or {}).get(channel)
+        if (confirmations is None) and (len(websockets) <= 1):
+            return list(message_ids)
+
+        if self.confirmations is None:
+            self.confirmations = {}
+        confirmations = self.confirmations.setdefault(channel, {})
+        confirmed = []
+        for message_id in message_ids:
+            confirmed_by = confirmations.setdefault(message_id, set())
+            confirmed_by.add(websocket)
+            if confirmed_by.issuperset(websockets):
+                del confirmations[message_id]
+                confirmed.append(message_id)
+        if not confirmations:
+            del self.confirmations[channel]
+        return confirmed
+
+    def forget_confirmations(self, channel, websocket):
+        """Forget delivery confirmations from closed WebSocket, must be
+        called after WebSocket is removed from channel WebSockets.
+
+        Messages may be already confirmed by all remaining WebSockets,
+        so their IDs are returned and such messages should be popped.
+
+        :param channel: Channel received messages
+        :param websocket: Closed WebSocket
+        :return: List of messages IDs
+
+        """
+        confirmations = (self.confirmations or {}).get(channel)
+        if confirmations is None:
+            return []
+        websockets = self.get_sockets(channel)
+        if not websockets:
+            del self.confirmations[channel]
+            return []
+        confirmed = []
+        for message_id, confirmed_by in list(confirmations.items()):
+            confirmed_by.discard(websocket)
+            if confirmed_by and confirmed_by.issuperset(websockets):
+                del confirmations[message_id]
+                confirmed.append(message_id)
+        if not confirmations:
+            del self.confirmations[channel]
+        return confirmed
+
     @asyncio.coroutine
     def pop_delivered(self, channel, message_id, proto=None):
         """Mark message as delivered by ID.
@@ -107,6 +289,28 @@ class BaseQueue:
         """
         pass
 
+    @asyncio.coroutine
+    def pop_delivered_many(self, channel, message_ids, proto=None):
+        """Mark multiple messages as delivered by IDs.
+
+        Default implementation calls :meth:`.pop_delivered` for every
+        message ID, queue implementations may redefine it to perform
+        single batched operation.
+
+        :param channel: Channel reveived messages
+        :param message_ids: List of messages IDs
+        :param proto: Messages protocol instance
+        :return: List of tuples (delivered message, from channel)
+
+        """
+        result = []
+        for message_id in message_ids:
+            delivered = yield from self.pop_delivered(
+                channel, message_id, proto=proto)
+            if delivered:
+                result.append(delivered)
+        return result
+
 
 class BaseMessagesCenter:
     """Messages center provides top-level messages routing.
@@ -118,18 +322,26 @@ class BaseMessagesCenter:
 
     Attributes:
 
-    - `.proto`: :class:`BaseProtocol` or subclass instance
+    - `.proto`: :class:`BaseProtocol` or subclass instance, messages
+      are put on queue in this protocol format
+    - `.protocols`: dict of extra protocols by WebSocket subprotocol
+      names, see :meth:`.add_protocol`
     - `.loop`: asyncio event loop
     - `.queue`: :class:`BaseQueue` subclass instance
     - `.routes`: routes objects list
+    - `.routes_types`: dict of message types handled by routes, see
+      :meth:`.add_route`
 
     """
     def __init__(self, loop=None, proto=None, queue=None):
         assert queue, "Error, queue argument not specified."
         self.loop = loop or asyncio.get_event_loop()
         self.proto = proto or base_proto.BaseProtocol()
+        self.protocols = {}
         self.queue = queue
         self.routes = []
+        self.routes_types = {}
+        self._routes_index = {}
 
     def add_socket(self, channel, websocket):
         """Register WebSocket for receiving messages from channel.
@@ -143,22 +355,74 @@ class BaseMessagesCenter:
     def del_socket(self, channel, websocket):
         """Unregister WebSocket from receiving messages from channel.
 
+        Messages confirmed by all remaining channel WebSockets are
+        popped then, see :meth:`.BaseQueue.forget_confirmations`.
+
         :param channel: String channel identifier, based on user id or some hash string
         :param websocket: Tornado WebSocket handler instance
 
         """
         self.queue.del_socket(channel, websocket, proto=self.proto)
+        message_ids = self.queue.forget_confirmations(channel, websocket)
+        if message_ids:
+            self.loop.create_task(
+                self._transport_gotit_many(message_ids, channel))
+
+    def add_protocol(self, proto):
+        """Add protocol which WebSocket connections may select with
+        subprotocol negotiation, see :attr:`.BaseProtocol.SUBPROTOCOL`.
+
+        Messages from connection are loaded with its protocol and then
+        put on queue in :attr:`.proto` format, and messages from queue
+        are recoded back on writing to connection, see :meth:`.recode`.
+
+        :param proto: Protocol instance
+
+        """
+        assert proto.SUBPROTOCOL, "Error, protocol has no subprotocol name."
+        self.protocols[proto.SUBPROTOCOL] = proto
 
-    def add_route(self, route):
+    def get_proto(self, websocket=None):
+        """Get protocol for WebSocket connection, main protocol is
+        returned if connection has not selected other one.
+
+        :param websocket: WebSocket handler instance
+
+        """
+        return getattr(websocket, 'proto', None) or self.proto
+
+    def recode(self, raw_message, proto):
+        """Recode message dump from main protocol to other protocol.
+
+        :param raw_message: Message dump in :attr:`.proto` format
+        :param proto: Target protocol instance
+
+        """
+        if proto is self.proto:
+            return raw_message
+        return proto.dump_message(self.proto.load_message(raw_message))
+
+    def add_route(self, route, types=None):
         """Add messages route to routing chain, see :class:`.BaseRoute`
 
         Message routes are processed in the same order as they added.
 
+        If route handles only certain message types, then it's
+        skipped for other messages without calling, see
+        :meth:`.get_routes`.
+
         :param route: Route instance
+        :param types: Message types handled by route, by default
+                      :attr:`.BaseRoute.types` is used
 
         """
         assert (not route in self.routes), ("Error, route %s is already added." % route)
+        if types is None:
+            types = getattr(route, 'types', None)
         self.routes.append(route)
+        if types is not None:
+            self.routes_types[route] = frozenset(types)
+        self._routes_index.clear()
 
     def del_route(self, route):
         """Remove message route, see :class:`.BaseRoute`
@@ -167,6 +431,31 @@ class BaseMessagesCenter:
 
         """
         self.routes.remove(route)
+        self.routes_types.pop(route, None)
+        self._routes_index.clear()
+
+    def get_routes(self, message_type):
+        """Get routes chain for message type, routes without declared
+        types and routes handling that type in the order they added.
+
+        Chains are computed once per type and cached until routes
+        are changed.
+
+        :param message_type: Message type
+
+        """
+        try:
+            routes = self._routes_index.get(message_type)
+        except TypeError:
+            # Unhashable type is not handled by any typed route
+            return tuple(route for route in self.routes
+                         if route not in self.routes_types)
+        if routes is None:
+            routes = self._routes_index[message_type] = tuple(
+                route for route in self.routes
+                if (route not in self.routes_types) or
+                   (message_type in self.routes_types[route]))
+        return routes
 
     @asyncio.coroutine
     def transport(self, message=None, websocket=None):
@@ -190,6 +479,9 @@ class BaseMessagesCenter:
             # Received (type=200)
             elif message['type'] == self.proto.TRANS_RECV_GOT_IT:
                 yield from self._transport_gotit(message, websocket)
+            # Accepts batches (type=1003)
+            elif message['type'] == self.proto.TRANS_BATCH:
+                yield from self._transport_batch(message, websocket)
         # Respond to data message, start delivery
         else:
             yield from self._transport_start(message, websocket)
@@ -197,8 +489,13 @@ class BaseMessagesCenter:
     @asyncio.coroutine
     def _transport_ping(self, message, websocket):
         """Process ping type=1001 transport message."""
-        pong = self.proto.make_message(type=self.proto.TRANS_PONG)
-        websocket.write_message(pong)
+        websocket.write_transport(self.proto.TRANS_PONG)
+
+    @asyncio.coroutine
+    def _transport_batch(self, message, websocket):
+        """Process batches type=1003 transport message, enable
+        sending messages batches to WebSocket."""
+        websocket.start_batching()
 
     @asyncio.coroutine
     def _transport_start(self, message, websocket):
@@ -207,7 +504,7 @@ class BaseMessagesCenter:
         'Got It' type=100."""
         got_it = self.proto.make_message(
             type=self.proto.TRANS_SERV_GOT_IT, data=message['id'])
-        websocket.write_message(got_it)
+        websocket.write_frame(self.proto.dump_message(got_it))
 
     @asyncio.coroutine
     def _transport_gotit(self, message, websocket):
@@ -216,9 +513,28 @@ class BaseMessagesCenter:
         Pop and mark message as delivered by ID, and then
         notify message sender on successful delivery.
 
+        If message data is list of IDs, then all messages are popped
+        in one batch and every sender is notified once with list of
+        delivered IDs.
+
+        If channel has multiple WebSockets, message is popped only
+        when all of them have confirmed it, see
+        :meth:`.BaseQueue.confirm_delivered`.
+
         """
         message_id = message['data']
         channel = websocket.get_channel()
+
+        if isinstance(message_id, list):
+            message_ids = self.queue.confirm_delivered(
+                channel, message_id, websocket)
+            if message_ids:
+                yield from self._transport_gotit_many(message_ids, channel)
+            return
+
+        if not self.queue.confirm_delivered(channel, [message_id], websocket):
+            return
+
         delivered = yield from self.queue.pop_delivered(
             channel, message_id, proto=self.proto)
 
@@ -231,6 +547,66 @@ class BaseMessagesCenter:
                                               notify_message,
                                               proto=self.proto)
 
+    @asyncio.coroutine
+    def _transport_gotit_many(self, message_ids, channel):
+        """Process 'Got It' type=200 transport message with list of IDs."""
+        delivered = yield from self.queue.pop_delivered_many(
+            channel, message_ids, proto=self.proto)
+
+        notify_ids = {}
+        for delivered_message, from_channel in delivered:
+            notify_ids.setdefault(from_channel, []).append(
+                delivered_message['id'])
+
+        for from_channel, ids in notify_ids.items():
+            notify_message = self.proto.make_message(
+                type=self.proto.TRANS_DELIVERED, data=ids)
+            yield from self.queue.put_message([from_channel],
+                                              notify_message,
+                                              proto=self.proto)
+
+    @asyncio.coroutine
+    def process_routes(self, message, websocket=None):
+        """Process message to routing chain and get destinations.
+
+        Routes are processed one by one, except adjacent routes marked
+        as :attr:`.BaseRoute.concurrent`, which are processed together
+        with ``asyncio.gather()``. Results are still handled in routes
+        order, so if route returns ``True``, results of next routes
+        are ignored even if they were already processed.
+
+        :param message: Message object
+        :param websocket: WebSocket connection handler received message
+        :return: List of tuples (route, channel or :class:`.Group`)
+
+        """
+        destinations = []
+        routes = self.get_routes(message.get('type'))
+        i, count = 0, len(routes)
+        while i < count:
+            j = i + 1
+            if routes[i].concurrent:
+                while (j < count) and routes[j].concurrent:
+                    j += 1
+            if j - i > 1:
+                chunk = routes[i:j]
+                results = yield from asyncio.gather(
+                    *[route.process(message, websocket, proto=self.proto)
+                      for route in chunk], loop=self.loop)
+            else:
+                chunk = (routes[i],)
+                results = [(yield from routes[i].process(
+                    message, websocket, proto=self.proto))]
+            for route, to_channel in zip(chunk, results):
+                if to_channel is True:
+                    return destinations
+                elif isinstance(to_channel, (str, Group)):
+                    destinations.append((route, to_channel))
+                elif isinstance(to_channel, (list, tuple)):
+                    destinations.extend((route, ch) for ch in to_channel)
+            i = j
+        return destinations
+
     @asyncio.coroutine
     def process(self, raw_or_message, websocket=None):
         """Process message to routing chain and send to WebSockets.
@@ -238,15 +614,19 @@ class BaseMessagesCenter:
         Message is passed to registered routes, they return receivers
         channels and then message is sent to that channels.
 
-        :param raw_or_message: Raw message string or message dict
+        :param raw_or_message: Raw message str or bytes or message dict,
+                               raw message is decoded and wrapped into
+                               :class:`.Message` envelope
         :param websocket: WebSocket connection handler received new message,
                           this is optional parameter, because message could
                           also be created at server internally
 
         """
         try:
-            if isinstance(raw_or_message, str):
-                message = self.proto.load_message(raw_or_message)
+            if isinstance(raw_or_message, (str, bytes)):
+                proto = self.get_proto(websocket)
+                message = proto.load_envelope(raw_or_message)
+                message.decode()
             else:
                 message = raw_or_message
         except ValueError as e:
@@ -262,21 +642,22 @@ class BaseMessagesCenter:
                 return
 
         # Data message
-        destinations = []
-        for route in self.routes:
-            to_channel = yield from route.process(message, websocket, proto=self.proto)
-            if to_channel is True:
-                break
-            elif isinstance(to_channel, str):
-                destinations.append((route, to_channel))
+        destinations = yield from self.process_routes(message, websocket)
 
         # Put on delivery queue
         if destinations:
             from_channel = websocket.get_channel() if websocket else None
-            to_channels = [d[1] for d in destinations]
-            yield from self.queue.put_message(to_channels, message,
-                                              proto=self.proto,
-                                              from_channel=from_channel)
+            to_channels = [d[1] for d in destinations
+                           if not isinstance(d[1], Group)]
+            if to_channels:
+                yield from self.queue.put_message(to_channels, message,
+                                                  proto=self.proto,
+                                                  from_channel=from_channel)
+            for group in {d[1] for d in destinations
+                          if isinstance(d[1], Group)}:
+                yield from self.queue.put_group_message(
+                    group, message, proto=self.proto,
+                    from_channel=from_channel)
 
         # Post process message
         for (route, to_channel) in destinations:
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import collections
+from . import base
+
+log = logging.getLogger(__name__)
+
+
+class MemoryMessagesCenter(base.BaseMessagesCenter):
+    """Messages center with in-process memory queue.
+
+    Suitable for single node deployments and benchmarks, messages are
+    not shared between processes and are lost on restart.
+
+    :param loop: asyncio event loop
+    :param proto: Messages protocol instance, default is
+                  :class:`.BaseProtocol`
+    :param reliable: Use reliable queue or simple queue, default is ``False``
+    :param maxsize: Max number of messages stored per channel
+
+    """
+    def __init__(self, loop=None, proto=None, reliable=False, maxsize=1000):
+        queue_cls = ReliableMemoryQueue if reliable else MemoryQueue
+        queue = queue_cls(loop=loop, maxsize=maxsize)
+        super().__init__(loop=loop, proto=proto, queue=queue)
+
+    @asyncio.coroutine
+    def init(self):
+        """Initialize messages center, nothing to setup for memory queue."""
+        pass
+
+    @asyncio.coroutine
+    def done(self):
+        pass
+
+
+class MemoryQueue(base.BaseQueue):
+    """Messages queue in process memory.
+
+    1. Messages for connected channels are written to WebSockets
+       right away.
+
+    2. Messages for channels without connections are stored in bounded
+       per channel queue, the oldest messages are dropped on overflow.
+       Stored messages are sent on next connection.
+
+    3. Groups members are stored as sets in ``groups`` dict.
+
+    :param loop: asyncio event loop
+    :param maxsize: Max number of messages stored per channel
+
+    """
+    def __init__(self, loop=None, maxsize=1000):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.sockets = {}
+        self.queues = {}
+        self.groups = {}
+
+    def add_socket(self, channel, websocket, proto=None):
+        """Register WebSocket for receiving messages from channel.
+
+        :param channel: String channel identifier, based on user id or some hash string
+        :param websocket: Tornado WebSocket handler instance
+        :param proto: Messages protocol instance
+
+        """
+        websocket.write_transport(proto.TRANS_READY)
+        self.sockets.setdefault(channel, []).append(websocket)
+        self._send_stored(channel, websocket)
+
+    def del_socket(self, channel, websocket, proto=None):
+        """Unregister WebSocket from receiving messages from channel.
+
+        :param channel: String channel identifier, based on user id or some hash string
+        :param websocket: Tornado WebSocket handler instance
+        :param proto: Messages protocol instance
+
+        """
+        websockets = self.sockets.get(channel, [])
+        if websocket in websockets:
+            websockets.remove(websocket)
+        if not websockets:
+            self.sockets.pop(channel, None)
+
+    def get_sockets(self, channel):
+        """Get WebSockets listening channel."""
+        return self.sockets.get(channel, ())
+
+    @asyncio.coroutine
+    def put_message(self, channels, message, proto=None, from_channel=None):
+        """Put messages on queue.
+
+        :param channels: List of destination channels
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if isinstance(message, (str, bytes)):
+            message_dump = message
+        else:
+            message_dump = proto.dump_message(message)
+
+        for channel in channels:
+            websockets = self.sockets.get(channel)
+            if websockets:
+                for websocket in websockets:
+                    websocket.write_frame(message_dump)
+            else:
+                self._store(channel, message_dump)
+
+    @asyncio.coroutine
+    def add_group_members(self, group, channels):
+        """Add channels to group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        name = getattr(group, 'name', group)
+        self.groups.setdefault(name, set()).update(channels)
+
+    @asyncio.coroutine
+    def del_group_members(self, group, channels):
+        """Remove channels from group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        name = getattr(group, 'name', group)
+        members = self.groups.get(name)
+        if members is not None:
+            members.difference_update(channels)
+            if not members:
+                del self.groups[name]
+
+    @asyncio.coroutine
+    def get_group_members(self, group):
+        """Get group channels.
+
+        :param group: :class:`.Group` instance or group name
+        :return: Set of channels
+
+        """
+        return set(self.groups.get(getattr(group, 'name', group), ()))
+
+    def _store(self, channel, message_dump):
+        """Store message for channel without connections."""
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = collections.deque(
+                maxlen=self.maxsize)
+        elif len(queue) == self.maxsize:
+            log.warning("Queue for %s is full, dropping oldest "
+                        "message" % channel)
+        queue.append(message_dump)
+
+    def _send_stored(self, channel, websocket):
+        """Send messages stored while channel had no connections."""
+        queue = self.queues.pop(channel, None)
+        while queue:
+            websocket.write_frame(queue.popleft())
+
+
+class ReliableMemoryQueue(MemoryQueue):
+    """Reliable messages queue in process memory.
+
+    1. Every message with ID is stored in per channel ordered dict
+       until delivery confirmation, see :meth:`.pop_delivered`.
+
+    2. Messages for connected channels are written to WebSockets
+       right away, all unconfirmed messages are sent again on
+       next connection.
+
+    3. Number of unconfirmed messages per channel is bounded, the
+       oldest messages are dropped on overflow.
+
+    4. Messages without ID are handled as in :class:`.MemoryQueue`.
+
+    :param loop: asyncio event loop
+    :param maxsize: Max number of messages stored per channel
+
+    """
+    def __init__(self, loop=None, maxsize=1000):
+        super().__init__(loop=loop, maxsize=maxsize)
+        self.waiting = {}
+
+    @asyncio.coroutine
+    def put_message(self, channels, message, proto=None, from_channel=None):
+        """Put messages on queue.
+
+        :param channels: List of destination channels
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if isinstance(message, (str, bytes)) or ('id' not in message):
+            yield from super().put_message(channels, message, proto=proto,
+                                           from_channel=from_channel)
+            return
+
+        message_dump = proto.dump_message(message)
+        for channel in channels:
+            waiting = self.waiting.get(channel)
+            if waiting is None:
+                waiting = self.waiting[channel] = collections.OrderedDict()
+            elif len(waiting) >= self.maxsize:
+                log.warning("Wait queue for %s is full, dropping oldest "
+                            "message" % channel)
+                waiting.popitem(last=False)
+            waiting[message['id']] = (message_dump, from_channel or '')
+
+            for websocket in self.sockets.get(channel, ()):
+                websocket.write_frame(message_dump)
+
+    @asyncio.coroutine
+    def check_delivered(self, channel, message_id):
+        """Check if message is delivered."""
+        return message_id not in self.waiting.get(channel, ())
+
+    @asyncio.coroutine
+    def pop_delivered(self, channel, message_id, proto=None):
+        """Pop delivered message by ID.
+
+        :param channel: Channel reveived message
+        :param message_id: Message ID
+        :param proto: Messages protocol instance
+        :return: Tuple (delivered message, from channel)
+
+        """
+        waiting = self.waiting.get(channel)
+        if waiting and (message_id in waiting):
+            message_dump, from_channel = waiting.pop(message_id)
+            if not waiting:
+                del self.waiting[channel]
+            return proto.load_message(message_dump), from_channel
+
+    def _send_stored(self, channel, websocket):
+        """Send unconfirmed messages and messages without ID stored
+        while channel had no connections."""
+        super()._send_stored(channel, websocket)
+        for message_dump, _ in list(self.waiting.get(channel, {}).values()):
+            websocket.write_frame(message_dump)
@@ -75,6 +75,10 @@ They have very simple format::
         "sign": (str, optional) Signature
     }
 
+Receiver may also confirm multiple messages at once with list of
+messages IDs as "data" of type 200 message, then server notifies each
+sender with single type 300 message with list of delivered IDs.
+
 Types description table:
 
 ======= =================================================================
@@ -86,21 +90,216 @@ Type    Description
 ------- -----------------------------------------------------------------
 300     server => sender, server has delivered message
 ------- -----------------------------------------------------------------
+400     server => sender, server has rejected message, i.e. on overflow
+------- -----------------------------------------------------------------
 1000    server => client, connection "ready" message
 ------- -----------------------------------------------------------------
 1001    "ping" message, should be responded with "pong"
 ------- -----------------------------------------------------------------
 1002    "pong" message, should be sent in response to "ping"
+------- -----------------------------------------------------------------
+1003    server <= client, client accepts messages batches
 ======= =================================================================
 
+Messages batches
+----------------
+
+Client may send type 1003 message to enable batching, then messages
+ready for sending within short time window are sent as single frame
+with array of messages, i.e. ``[{"id": ...}, {"id": ...}]``. Single
+messages are still sent as is, so client should accept both arrays
+and messages objects.
+
 """
 import json
+import struct
+import collections.abc
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = (
+    'Message',
+    'BaseProtocol',
+    'MsgPackProtocol',
+    'JSONCodec',
+    'OrjsonCodec',
+    'UjsonCodec',
+    'RapidjsonCodec',
+    'get_json_codec',
+)
+
+
+class JSONCodec:
+    """Standard library `json` codec.
+
+    Codecs implement ``loads()`` accepting str or bytes and ``dumps()``
+    returning str or bytes. Dumps may be passed to Redis and WebSocket
+    as is, so bytes-native codecs don't need str round trip.
+    """
+    name = 'json'
+
+    def loads(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return json.loads(raw)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+
+class OrjsonCodec(JSONCodec):
+    """`orjson` codec, dumps to bytes."""
+    name = 'orjson'
+
+    def loads(self, raw):
+        return orjson.loads(raw)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+class UjsonCodec(JSONCodec):
+    """`ujson` codec."""
+    name = 'ujson'
+
+    def loads(self, raw):
+        return ujson.loads(raw)
+
+    def dumps(self, obj):
+        return ujson.dumps(obj)
+
+
+class RapidjsonCodec(JSONCodec):
+    """`python-rapidjson` codec."""
+    name = 'rapidjson'
+
+    def loads(self, raw):
+        return rapidjson.loads(raw)
+
+    def dumps(self, obj):
+        return rapidjson.dumps(obj)
+
+
+def get_json_codec():
+    """Get the fastest installed JSON codec: `orjson`, `ujson`,
+    `python-rapidjson` or standard library `json` as fallback."""
+    if orjson:
+        return OrjsonCodec()
+    if ujson:
+        return UjsonCodec()
+    if rapidjson:
+        return RapidjsonCodec()
+    return JSONCodec()
+
 
-__all__ = ('BaseProtocol',)
+class Message(collections.abc.MutableMapping):
+    """Message envelope, keeps raw message as received along with
+    loaded fields. Incoming frames are decoded right away for
+    validation, envelope saves encoding on relaying.
+
+    Message behaves as dict, and if it's not changed, then dumping with
+    the same protocol just returns raw message, so relayed messages are
+    not encoded again.
+
+    Only top level fields assignment and deletion are tracked, nested
+    values changed in place, i.e. ``message['data']['text'] = ''``,
+    require explicit :meth:`.mark_changed` call, otherwise original
+    raw message is sent.
+
+    Message is not dict instance, so routes passing it to code which
+    expects dict, i.e. to ``json.dumps()``, should use :meth:`.copy`.
+
+    :param raw: Raw message str or bytes
+    :param proto: Protocol instance to load message with
+
+    """
+    __slots__ = ('raw', 'proto', '_fields', '_changed')
+
+    def __init__(self, raw, proto):
+        self.raw = raw
+        self.proto = proto
+        self._fields = None
+        self._changed = False
+
+    def decode(self):
+        """Load message fields dict if not loaded yet."""
+        if self._fields is None:
+            self._fields = self.proto.load_message(self.raw)
+        return self._fields
+
+    def mark_changed(self):
+        """Mark message as changed, so it's encoded again on dump."""
+        self.decode()
+        self._changed = True
+
+    def copy(self):
+        """Get shallow copy of message fields as dict."""
+        return dict(self.decode())
+
+    def dump(self, proto):
+        """Dump message with protocol, raw message is returned as is
+        if message is not changed and protocol is the same."""
+        if self._changed or (proto is not self.proto):
+            return proto.dump_message(self.decode())
+        return self.raw
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __setitem__(self, key, value):
+        self.decode()[key] = value
+        self._changed = True
+
+    def __delitem__(self, key):
+        del self.decode()[key]
+        self._changed = True
+
+    def __contains__(self, key):
+        return key in self.decode()
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __repr__(self):
+        return '<Message %r>' % (self._fields or self.raw,)
 
 
 class BaseProtocol:
-    """Basics for messages loading, dumping and format validation."""
+    """Basics for messages loading, dumping and format validation.
+
+    :param codec: JSON codec instance, by default the fastest installed
+                  codec is used, see :func:`.get_json_codec`
+
+    Attributes:
+
+    - `.SUBPROTOCOL`: WebSocket subprotocol name to select protocol
+    - `.binary`: Write messages as binary WebSocket frames
+
+    """
+    SUBPROTOCOL = 'bachata.json'
+
+    binary = False
 
     TRANS_READY = 1000 # connected
     TRANS_PING = 1001 # ping
@@ -108,16 +307,29 @@ class BaseProtocol:
     TRANS_SERV_GOT_IT = 100 # SERVER => SENDER, start sending
     TRANS_RECV_GOT_IT = 200 # SERVER <= RECEIVER, received
     TRANS_DELIVERED = 300 # SERVER => SENDER, delivered
+    TRANS_REJECTED = 400 # SERVER => SENDER, rejected
+    TRANS_BATCH = 1003 # SERVER <= CLIENT, accepts batches
     TRANS_TYPES = (
         TRANS_PING, TRANS_PONG,
         TRANS_SERV_GOT_IT, TRANS_RECV_GOT_IT,
-        TRANS_DELIVERED)
+        TRANS_DELIVERED, TRANS_REJECTED, TRANS_BATCH)
+
+    _frames = None
+
+    _ping_frames = None
+
+    def __init__(self, codec=None):
+        self.codec = codec or get_json_codec()
 
     def load_message(self, raw_message):
-        """Load message to dict from str."""
-        message = json.loads(raw_message)
+        """Load message to dict from str or bytes."""
+        message = self.codec.loads(raw_message)
         return message
 
+    def load_envelope(self, raw_message):
+        """Wrap raw message to :class:`.Message` envelope."""
+        return Message(raw_message, self)
+
     def make_message(self, id=None, type=None, time=None, dest=None,
                      from_=None, sign=None, data=None):
         """Create new message dict."""
@@ -132,5 +344,81 @@ class BaseProtocol:
         return msg
 
     def dump_message(self, message):
-        """Dump message to str."""
-        return json.dumps(message)
+        """Dump message to str or bytes, depending on codec."""
+        if isinstance(message, Message):
+            return message.dump(self)
+        return self.codec.dumps(message)
+
+    def dump_batch(self, raw_messages):
+        """Join messages dumps to array dump without loading them."""
+        raw_messages = [m.encode('utf-8') if isinstance(m, str) else m
+                        for m in raw_messages]
+        return b'[' + b','.join(raw_messages) + b']'
+
+    def transport_frame(self, message_type):
+        """Get dump of constant transport message without data, i.e.
+        "ready" or "pong", dumps are cached per protocol instance."""
+        if self._frames is None:
+            self._frames = {}
+        frame = self._frames.get(message_type)
+        if frame is None:
+            frame = self._frames[message_type] = self.dump_message(
+                self.make_message(type=message_type))
+        return frame
+
+    def is_ping(self, raw_message):
+        """Check if raw message is "ping" transport message without
+        loading it, see :meth:`.get_ping_frames`."""
+        if self._ping_frames is None:
+            frames = self.get_ping_frames()
+            self._ping_frames = (max(len(f) for f in frames), frames)
+        max_size, frames = self._ping_frames
+        return (len(raw_message) <= max_size) and (raw_message in frames)
+
+    def get_ping_frames(self):
+        """Get set of "ping" messages dumps recognized by :meth:`.is_ping`,
+        other "ping" messages are processed as usual."""
+        frames = {'{"type":%d}' % self.TRANS_PING,
+                  '{"type": %d}' % self.TRANS_PING}
+        return frozenset(frames | {f.encode('utf-8') for f in frames})
+
+
+class MsgPackProtocol(BaseProtocol):
+    """MessagePack messages protocol, messages are written as binary
+    WebSocket frames. Requires `msgpack` package.
+
+    Messages format is the same as for JSON protocol.
+
+    """
+    SUBPROTOCOL = 'bachata.msgpack'
+
+    binary = True
+
+    def __init__(self):
+        assert msgpack, "Error, msgpack package is not installed."
+        super().__init__()
+
+    def load_message(self, raw_message):
+        """Load message to dict from bytes."""
+        return msgpack.unpackb(raw_message, raw=False)
+
+    def dump_message(self, message):
+        """Dump message to bytes."""
+        if isinstance(message, Message):
+            return message.dump(self)
+        return msgpack.packb(message, use_bin_type=True)
+
+    def dump_batch(self, raw_messages):
+        """Join messages dumps to array dump without loading them."""
+        size = len(raw_messages)
+        if size < 16:
+            header = struct.pack('B', 0x90 | size)
+        elif size < 0x10000:
+            header = struct.pack('>BH', 0xdc, size)
+        else:
+            header = struct.pack('>BI', 0xdd, size)
+        return header + b''.join(raw_messages)
+
+    def get_ping_frames(self):
+        """Get set of "ping" messages dumps recognized by :meth:`.is_ping`."""
+        return frozenset((self.transport_frame(self.TRANS_PING),))
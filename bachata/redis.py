@@ -1,11 +1,104 @@
+import uuid
+import random
+import hashlib
 import asyncio
 import aioredis
 import logging
+from aioredis.pubsub import Receiver
 from . import base
 
 log = logging.getLogger(__name__)
 
 
+class RedisScript:
+    """Lua script registered on Redis server and called by SHA1 digest.
+
+    Script is loaded once with :meth:`.load` on queue connect and then
+    called with EVALSHA. If server has lost script, i.e. after restart
+    or SCRIPT FLUSH, it's sent again with EVAL.
+
+    :param sources: Lua script source parts
+
+    """
+    def __init__(self, *sources):
+        self.source = '\n'.join(sources)
+        self.digest = hashlib.sha1(self.source.encode('utf-8')).hexdigest()
+
+    @asyncio.coroutine
+    def load(self, redis_conn):
+        """Load script to Redis server scripts cache."""
+        yield from redis_conn.script_load(self.source)
+
+    @asyncio.coroutine
+    def call(self, redis_conn, keys=(), args=()):
+        """Run script and return result."""
+        keys, args = list(keys), list(args)
+        try:
+            return (yield from redis_conn.evalsha(
+                self.digest, keys=keys, args=args))
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return (yield from redis_conn.eval(
+            self.source, keys=keys, args=args))
+
+
+# Get message dump by message key, message is stored either as list
+# [message dump, from channel] or with shared body as list
+# ['', from channel, body key], see ReliableRedisQueue.
+LUA_MESSAGE_DUMP = """
+    local function message_dump(message_key)
+        local values = redis.call('LRANGE', message_key, 0, 2)
+        if values[1] == '' and values[3] then
+            return redis.call('HGET', values[3], 'body')
+        end
+        return values[1] or false
+    end
+"""
+
+# Put message on channel queue, see ReliableRedisQueue. Message with ID
+# is stored under "{channel}:{message id}" key and the key is pushed to
+# incoming queue or to wait queue for local channel. With notify flag
+# "{channel}:ready" key gets value if it's empty, for shared listener.
+LUA_PUT_MESSAGE = """
+    local function put_message(channel, message_id, dump, from_channel,
+                               expire, body_key, is_local, notify)
+        if message_id ~= '' then
+            local message_key = channel .. ':' .. message_id
+            if body_key ~= '' then
+                redis.call('RPUSH', message_key, '', from_channel, body_key)
+            else
+                redis.call('RPUSH', message_key, dump, from_channel)
+            end
+            if expire > 0 then
+                redis.call('EXPIRE', message_key, expire)
+            end
+            -- Messages for local channels are sent directly
+            -- and put on wait queue right away
+            if is_local then
+                redis.call('LPUSH', channel .. ':wait', message_key)
+            else
+                redis.call('LPUSH', channel, message_key)
+            end
+        else
+            redis.call('LPUSH', channel, dump)
+        end
+        if expire > 0 and not is_local then
+            redis.call('EXPIRE', channel, expire)
+        end
+        if notify and not is_local then
+            local ready_key = channel .. ':ready'
+            if redis.call('LLEN', ready_key) == 0 then
+                redis.call('LPUSH', ready_key, '1')
+            end
+            if expire > 0 then
+                redis.call('EXPIRE', ready_key, expire)
+            end
+        end
+    end
+"""
+
+
 class RedisMessagesCenter(base.BaseMessagesCenter):
     """Messages center on top of Redis LPUSH / BRPOP pattern.
 
@@ -14,14 +107,37 @@ class RedisMessagesCenter(base.BaseMessagesCenter):
 
     :param loop: asyncio event loop
     :param conn_params: Redis connection params as dict
+    :param proto: Messages protocol instance, messages are put on queue
+                  in this protocol format, default is :class:`.BaseProtocol`
     :param reliable: Use reliable queue or simple queue, default is ``False``
+    :param streams: Use reliable queue on Redis Streams, see
+                    :class:`.StreamRedisQueue`, default is ``False``
+    :param node_inbox: Use simple queue with single incoming list per
+                       node, see :class:`.NodeRedisQueue`, default is
+                       ``False``
+    :param listener_conns: Number of Redis connections for shared queue
+                           listener, see :class:`.RedisQueueListener`,
+                           default is ``None`` which means connection per
+                           channel, node inbox doesn't use it
+    :param queue_params: Extra queue params, see :class:`.ReliableRedisQueue`,
+                         :class:`.StreamRedisQueue` and :class:`.NodeRedisQueue`
 
     """
-    def __init__(self, loop=None, conn_params=None, reliable=False):
+    def __init__(self, loop=None, conn_params=None, proto=None,
+                 reliable=False, listener_conns=None, streams=False,
+                 node_inbox=False, **queue_params):
         self.conn_params = conn_params
-        queue_cls = ReliableRedisQueue if reliable else RedisQueue
-        queue = queue_cls(loop=loop, conn_params=conn_params)
-        super().__init__(loop=loop, queue=queue)
+        if streams:
+            queue_cls = StreamRedisQueue
+        elif node_inbox:
+            assert not reliable, ("Error, node inbox is not supported "
+                                  "for reliable queue.")
+            queue_cls = NodeRedisQueue
+        else:
+            queue_cls = ReliableRedisQueue if reliable else RedisQueue
+        queue = queue_cls(loop=loop, conn_params=conn_params,
+                          listener_conns=listener_conns, **queue_params)
+        super().__init__(loop=loop, proto=proto, queue=queue)
 
     @asyncio.coroutine
     def init(self):
@@ -41,18 +157,103 @@ class RedisQueue(base.BaseQueue):
     1. Messages are LPUSH'ed to list with "{channel}" key.
 
     2. Receiver just listens for "{channel}" list updates
-       with BRPOP.
+       with BRPOP. Channel is listened once per process and messages
+       are written to all its WebSockets, i.e. to all user devices.
+       Listening task is cancelled when the last channel WebSocket is
+       closed, so closing costs no Redis writes.
+
+    3. With ``listener_conns`` specified all channels of the process
+       are served by shared :class:`.RedisQueueListener` instead of
+       separate connection per channel.
+
+    4. With ``local_delivery`` enabled messages for channels listened
+       on this process are written to WebSockets directly, without
+       passing through Redis. Once message for such channel is put on
+       Redis, i.e. because of full outgoing buffer, further messages
+       follow it until it's received, see :meth:`.hold_local`.
+
+    5. Groups members are stored as set with "bachata:group:{name}" key,
+       message for group is pushed to members queues by Lua script,
+       see :meth:`.put_group_message`.
+
+    6. Messages of ``pubsub_types`` are ephemeral, they are not stored
+       but PUBLISH'ed to "bachata:pubsub:{channel}" and received by
+       single subscriber connection per process. Such messages are
+       lost for offline channels and dropped for WebSockets with full
+       outgoing buffer. Subscriber connection is reopened on failure,
+       see :meth:`.listen_pubsub`.
+
+    7. Producer operations, i.e. putting and popping messages, are
+       performed over pool of up to ``pool_size`` connections, see
+       :meth:`.connect`. Broken connections are replaced by pool on
+       demand, and pool is checked with PING every
+       :attr:`.HEALTH_INTERVAL` seconds.
 
     :param loop: asyncio event loop
     :param websocket: WebSocket handler instance
     :param conn_params: Redis connection params
+    :param listener_conns: Number of shared listener connections
+    :param local_delivery: Deliver messages to local channels directly,
+                           default is ``False``
+    :param pubsub_types: Types of ephemeral messages delivered with
+                         Pub/Sub, default is ``None``
+    :param pool_size: Max number of producer connections, default is
+                      ``None`` which means single connection
 
     """
-    CLOSE_COMMAND = '!'
+    POOL_MINSIZE = 1
+
+    CONNECT_ATTEMPTS = 5
+
+    RECONNECT_DELAY = 0.5
+
+    RECONNECT_MAX_DELAY = 30
 
-    def __init__(self, loop=None, conn_params=None):
+    HEALTH_INTERVAL = 30
+
+    GROUP_KEY = 'bachata:group:%s'
+
+    PUBSUB_KEY = 'bachata:pubsub:%s'
+
+    LISTEN_CHUNK = 100
+
+    # KEYS: group key
+    # ARGV: SSCAN cursor, chunk size, message dump
+    # Returns next SSCAN cursor.
+    GROUP_PUT_SCRIPT = RedisScript("""
+        redis.replicate_commands()
+        local scan = redis.call('SSCAN', KEYS[1], ARGV[1],
+                                'COUNT', ARGV[2])
+        local seen = {}
+        for _, channel in ipairs(scan[2]) do
+            if not seen[channel] then
+                seen[channel] = true
+                redis.call('LPUSH', channel, ARGV[3])
+            end
+        end
+        return scan[1]
+    """)
+
+    SCRIPTS = (GROUP_PUT_SCRIPT,)
+
+    def __init__(self, loop=None, conn_params=None, listener_conns=None,
+                 local_delivery=False, pubsub_types=None, pool_size=None):
         self.loop = loop
         self.conn_params = conn_params
+        self.local_delivery = local_delivery
+        self.pool_size = pool_size or 1
+        self.health_task = None
+        self.attach_tasks = {}
+        self.listen_tasks = {}
+        self.pubsub_types = frozenset(pubsub_types or ())
+        self.pubsub_conn = None
+        self.pubsub_task = None
+        self.sockets = {}
+        self.held = {}
+        if listener_conns:
+            self.listener = RedisQueueListener(self, size=listener_conns)
+        else:
+            self.listener = None
 
     def add_socket(self, channel, websocket, proto=None):
         """Register WebSocket for receiving messages from channel.
@@ -63,65 +264,659 @@ class RedisQueue(base.BaseQueue):
 
         """
         websocket.is_closed = False
-        ready_message = proto.make_message(type=proto.TRANS_READY)
-        websocket.write_message(proto.dump_message(ready_message))
-        self.loop.create_task(self.listen_queue(channel, websocket))
+        websocket.write_transport(proto.TRANS_READY)
+        self.attach_tasks[websocket] = self.loop.create_task(
+            self.attach(channel, websocket))
 
     def del_socket(self, channel, websocket, proto=None):
         """Unregister WebSocket from receiving messages from channel.
 
+        Channel listening task is cancelled with the last WebSocket.
+
         :param channel: String channel identifier, based on user id or some hash string
         :param websocket: Tornado WebSocket handler instance
         :param proto: Messages protocol instance
 
         """
         websocket.is_closed = True
-        self.loop.create_task(self.put_message(
-            [channel], self.CLOSE_COMMAND, proto=proto))
+        task = self.attach_tasks.pop(websocket, None)
+        if task:
+            task.cancel()
+        if self.unregister(channel, websocket):
+            if self.listener:
+                self.listener.remove(channel)
+            else:
+                task = self.listen_tasks.pop(channel, None)
+                if task:
+                    task.cancel()
 
     @asyncio.coroutine
     def connect(self):
-        """Setup main Redis connection."""
-        self.conn = yield from aioredis.create_redis(
-            loop=self.loop, **self.conn_params)
+        """Setup main Redis connections pool.
+
+        Pool is created with up to :attr:`.CONNECT_ATTEMPTS` attempts,
+        delay between attempts is doubled starting from
+        :attr:`.RECONNECT_DELAY`.
+
+        """
+        delay = self.RECONNECT_DELAY
+        for attempt in range(1, self.CONNECT_ATTEMPTS + 1):
+            try:
+                self.conn = yield from aioredis.create_redis_pool(
+                    loop=self.loop, minsize=self.POOL_MINSIZE,
+                    maxsize=max(self.pool_size, self.POOL_MINSIZE),
+                    **self.conn_params)
+                break
+            except (OSError, aioredis.RedisError) as e:
+                if attempt == self.CONNECT_ATTEMPTS:
+                    raise
+                log.warning("Redis connection failed: %s, retry in %ss" %
+                            (e, delay))
+                yield from asyncio.sleep(delay, loop=self.loop)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+        self.health_task = self.loop.create_task(self.check_health_forever())
+        for script in self.SCRIPTS:
+            yield from script.load(self.conn)
+        if self.listener:
+            self.listener.start()
+        if self.pubsub_types:
+            # Receiver is stopped by default when it has no channels
+            # left, but channels come and go with WebSockets
+            self.pubsub = Receiver(loop=self.loop,
+                                   on_close=self._on_pubsub_close)
+            yield from self.connect_pubsub()
+            self.pubsub_task = self.loop.create_task(self.listen_pubsub())
 
     @asyncio.coroutine
     def close(self):
+        if self.listener:
+            self.listener.stop()
+        if self.pubsub_task:
+            self.pubsub_task.cancel()
+            self.pubsub_task = None
+        if self.pubsub_conn:
+            self.pubsub_conn.close()
+            self.pubsub_conn = None
+        if self.health_task:
+            self.health_task.cancel()
+            self.health_task = None
         self.conn.close()
 
+    @asyncio.coroutine
+    def check_health_forever(self):
+        """Check connections pool with PING every :attr:`.HEALTH_INTERVAL`
+        seconds.
+
+        On failure idle connections are closed, so pool opens new
+        ones, and check is retried with growing delay starting from
+        :attr:`.RECONNECT_DELAY` until Redis is available again.
+
+        """
+        delay = self.HEALTH_INTERVAL
+        while True:
+            yield from asyncio.sleep(delay, loop=self.loop)
+            try:
+                yield from self.conn.ping()
+                delay = self.HEALTH_INTERVAL
+            except (OSError, aioredis.RedisError) as e:
+                if delay == self.HEALTH_INTERVAL:
+                    delay = self.RECONNECT_DELAY
+                else:
+                    delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                log.warning("Redis health check failed: %s, retry "
+                            "in %ss" % (e, delay))
+                yield from self.conn.connection.clear()
+
     @asyncio.coroutine
     def put_message(self, channels, message, proto=None, from_channel=None):
         """Put messages on queue.
 
+        Messages for all channels are sent as single pipelined batch.
+
         :param channels: List of destination channels
         :param message: Message dict object
         :param proto: Messages protocol instance
         :param from_channel: Message from channel
 
         """
-        if isinstance(message, str):
+        if self.is_ephemeral(message):
+            yield from self.publish(channels, message, proto=proto)
+            return
+
+        if isinstance(message, (str, bytes)):
             raw_message = message
         else:
             raw_message = proto.dump_message(message)
 
+        if self.local_delivery:
+            channels = self.write_local(channels, raw_message)
+            if not channels:
+                return
+
+        pipe = self.conn.pipeline()
         for ch in channels:
-            yield from self.conn.lpush(ch, raw_message)
+            pipe.lpush(ch, raw_message)
+        yield from pipe.execute()
+
+    def is_ephemeral(self, message):
+        """Check if message should be delivered with Pub/Sub,
+        see ``pubsub_types``."""
+        return bool(self.pubsub_types and
+                    not isinstance(message, (str, bytes)) and
+                    message.get('type') in self.pubsub_types)
 
     @asyncio.coroutine
-    def listen_queue(self, channel, websocket):
-        """Start queue listener for channel and WebSocket connection."""
-        redis_conn = yield from aioredis.create_redis(
+    def publish(self, channels, message, proto=None):
+        """Publish ephemeral message to channels, message is not stored.
+
+        :param channels: List of destination channels
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+
+        """
+        raw_message = proto.dump_message(message)
+
+        if self.local_delivery:
+            channels = self.write_local(channels, raw_message)
+            if not channels:
+                return
+
+        pipe = self.conn.pipeline()
+        for ch in channels:
+            pipe.publish(self.PUBSUB_KEY % ch, raw_message)
+        yield from pipe.execute()
+
+    @asyncio.coroutine
+    def connect_pubsub(self):
+        """Open subscriber connection and subscribe all channels of
+        the process, channels registered later are subscribed by
+        :meth:`.register`."""
+        self.pubsub_conn = None
+        conn = yield from aioredis.create_redis(
             loop=self.loop, **self.conn_params)
+        self.pubsub_conn = conn
+        if self.sockets:
+            yield from conn.subscribe(*[
+                self.pubsub.channel(self.PUBSUB_KEY % channel)
+                for channel in self.sockets])
+
+    def _on_pubsub_close(self, sender, exc=None):
+        pass
 
+    @asyncio.coroutine
+    def listen_pubsub(self):
+        """Receive ephemeral messages for all channels of the process
+        and write them to writable WebSockets.
+
+        When subscriber connection is lost, it's reopened after
+        :attr:`.RECONNECT_DELAY` seconds, messages published meanwhile
+        are lost.
+
+        """
+        reader = self.loop.create_task(self.read_pubsub())
+        try:
+            while True:
+                try:
+                    if self.pubsub_conn is None:
+                        yield from self.connect_pubsub()
+                    yield from self.pubsub_conn.wait_closed()
+                    log.warning("Pub/Sub connection closed, reconnecting")
+                except (OSError, aioredis.RedisError) as e:
+                    log.warning("Pub/Sub connection failed: %s" % e)
+                self.pubsub_conn = None
+                yield from asyncio.sleep(self.RECONNECT_DELAY, loop=self.loop)
+        finally:
+            reader.cancel()
+
+    @asyncio.coroutine
+    def read_pubsub(self):
+        prefix_len = len(self.PUBSUB_KEY % '')
         while True:
-            val = yield from redis_conn.brpop(channel, timeout=10)
-            log.debug("listen_queue: %s" % val)
-            if websocket.is_closed:
-                redis_conn.close()
+            received = yield from self.pubsub.get()
+            if received is None:
                 return
-            elif val:
-                websocket.write_message(val[1])
-            
+            sender, raw = received
+            channel = sender.name[prefix_len:].decode('utf-8')
+            for websocket in self.sockets.get(channel, ()):
+                if websocket.is_writable():
+                    websocket.write_frame(raw)
+
+    @asyncio.coroutine
+    def put_group_message(self, group, message, proto=None,
+                          from_channel=None):
+        """Put message on queue for all group members.
+
+        Message is pushed to members queues on Redis side, every script
+        call handles chunk of about :attr:`.GROUP_CHUNK` members, so
+        large group doesn't block Redis server and costs only few round
+        trips. Messages for group are not written to local WebSockets
+        directly even with ``local_delivery`` enabled. Ephemeral messages
+        are published to members by chunks.
+
+        Members repeated by SSCAN within chunk get message once, but
+        member may be returned again by next chunk if group set is
+        resized meanwhile, so delivery to group is at least once.
+
+        :param group: :class:`.Group` instance or group name
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if self.is_ephemeral(message):
+            yield from base.BaseQueue.put_group_message(
+                self, group, message, proto=proto)
+            return
+
+        if isinstance(message, (str, bytes)):
+            raw_message = message
+        else:
+            raw_message = proto.dump_message(message)
+
+        group_key = self.GROUP_KEY % getattr(group, 'name', group)
+        cursor = 0
+        while True:
+            cursor = yield from self.GROUP_PUT_SCRIPT.call(
+                self.conn, keys=[group_key],
+                args=(cursor, self.GROUP_CHUNK, raw_message))
+            if int(cursor) == 0:
+                break
+
+    @asyncio.coroutine
+    def add_group_members(self, group, channels):
+        """Add channels to group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        if channels:
+            yield from self.conn.sadd(
+                self.GROUP_KEY % getattr(group, 'name', group), *channels)
+
+    @asyncio.coroutine
+    def del_group_members(self, group, channels):
+        """Remove channels from group.
+
+        :param group: :class:`.Group` instance or group name
+        :param channels: List of channels
+
+        """
+        if channels:
+            yield from self.conn.srem(
+                self.GROUP_KEY % getattr(group, 'name', group), *channels)
+
+    @asyncio.coroutine
+    def get_group_members(self, group):
+        """Get group channels.
+
+        :param group: :class:`.Group` instance or group name
+        :return: Set of channels
+
+        """
+        members = yield from self.conn.smembers(
+            self.GROUP_KEY % getattr(group, 'name', group),
+            encoding='utf-8')
+        return set(members)
+
+    def register(self, channel, websocket):
+        """Register WebSocket as listening channel on this process.
+
+        :return: ``True`` if it's the first WebSocket for channel
+
+        """
+        websockets = self.sockets.setdefault(channel, [])
+        websockets.append(websocket)
+        if len(websockets) == 1:
+            if self.pubsub_conn:
+                self.loop.create_task(self.pubsub_conn.subscribe(
+                    self.pubsub.channel(self.PUBSUB_KEY % channel)))
+            return True
+        return False
+
+    def unregister(self, channel, websocket):
+        """Unregister WebSocket listening channel on this process.
+
+        :return: ``True`` if there are no WebSockets left for channel
+
+        """
+        websockets = self.sockets.get(channel, [])
+        if websocket in websockets:
+            websockets.remove(websocket)
+        if not websockets:
+            self.held.pop(channel, None)
+            if self.sockets.pop(channel, None) is not None:
+                if self.pubsub_conn:
+                    self.loop.create_task(self.pubsub_conn.unsubscribe(
+                        self.PUBSUB_KEY % channel))
+            return True
+        return False
+
+    def get_sockets(self, channel):
+        """Get WebSockets listening channel on this process."""
+        return self.sockets.get(channel, ())
+
+    def write_local(self, channels, raw_message):
+        """Write message to WebSockets listening channels on this process.
+
+        Channels with WebSockets which have full outgoing buffer are
+        not written, so messages for them wait in Redis.
+
+        :return: List of remaining channels, which are not listened
+                 on this process
+
+        """
+        remote = []
+        for channel in channels:
+            if self.is_local_writable(channel):
+                for websocket in self.sockets[channel]:
+                    websocket.write_frame(raw_message)
+            else:
+                if channel in self.sockets:
+                    self.hold_local(channel, raw_message)
+                remote.append(channel)
+        return remote
+
+    def is_local_writable(self, channel):
+        """Check if channel is listened on this process, all its
+        WebSockets are writable and no messages put on Redis for it
+        are still waiting there."""
+        websockets = self.sockets.get(channel)
+        return (bool(websockets) and (channel not in self.held) and
+                all(ws.is_writable() for ws in websockets))
+
+    def hold_local(self, channel, value):
+        """Remember the last value put on Redis for channel listened on
+        this process, so next messages are not written directly before
+        it's received, see :meth:`.release_local`.
+
+        :param channel: Message channel
+        :param value: Value as it's received by listener
+
+        """
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        self.held[channel] = value
+
+    def release_local(self, channel, value):
+        """Allow writing messages for channel directly again, if value
+        received by listener is the last one put on Redis."""
+        if self.held.get(channel) == value:
+            del self.held[channel]
+
+    @asyncio.coroutine
+    def attach(self, channel, websocket):
+        """Attach WebSocket to channel listener, listener is started
+        for the first channel WebSocket on this process, see
+        :meth:`.listen_queue`, or channel is added to shared listener.
+
+        """
+        if websocket.is_closed:
+            return
+        if self.register(channel, websocket):
+            self.start_listening(channel)
+
+    def start_listening(self, channel):
+        """Add channel to shared listener or start separate listening
+        task for it, if it's not listened yet."""
+        if self.listener:
+            self.listener.add(channel)
+        elif channel not in self.listen_tasks:
+            self.listen_tasks[channel] = self.loop.create_task(
+                self.listen_queue(channel))
+
+    @asyncio.coroutine
+    def listen_queue(self, channel):
+        """Start queue listener for channel, messages are written to all
+        channel WebSockets. Listener runs until task is cancelled on the
+        last channel WebSocket close."""
+        redis_conn = yield from aioredis.create_redis(
+            loop=self.loop, **self.conn_params)
+        try:
+            while True:
+                yield from self.wait_writable(channel)
+                val = yield from redis_conn.brpop(channel, timeout=0)
+                log.debug("listen_queue: %s" % val)
+                if not val:
+                    continue
+                websockets = self.sockets.get(channel)
+                if websockets:
+                    yield from self.dispatch(
+                        redis_conn, channel, val[1], list(websockets))
+                else:
+                    yield from redis_conn.rpush(channel, val[1])
+        finally:
+            redis_conn.close()
+
+    @asyncio.coroutine
+    def wait_writable(self, channel):
+        """Wait until all channel WebSockets have room in outgoing
+        buffers."""
+        for websocket in list(self.sockets.get(channel, ())):
+            yield from websocket.wait_writable()
+
+    @asyncio.coroutine
+    def dispatch(self, redis_conn, channel, raw, websockets):
+        """Write value received from channel queue by listener.
+
+        :param redis_conn: Listener Redis connection
+        :param channel: Message channel
+        :param raw: Raw value popped from channel queue
+        :param websockets: WebSockets registered for channel
+
+        """
+        for websocket in websockets:
+            websocket.write_frame(raw)
+        if self.held:
+            self.release_local(channel, raw)
+
+    @asyncio.coroutine
+    def receive_any(self, redis_conn, channels, wake_key):
+        """Wait for values on any of channels queues, used by shared
+        listener.
+
+        Single BRPOP is blocked on all channels, then the rest of popped
+        channel queue is drained without blocking by chunk of up to
+        :attr:`.LISTEN_CHUNK` values, so busy channel costs one call
+        with all shard keys per chunk instead of per message.
+
+        :param redis_conn: Listener Redis connection
+        :param channels: Listened channels
+        :param wake_key: Listener wake key, see :meth:`.wake_listener`
+        :return: List of tuples (channel, values from the oldest)
+
+        """
+        keys = list(channels)
+        keys.append(wake_key)
+        val = yield from redis_conn.brpop(*keys, timeout=0)
+        if not val:
+            return []
+        channel = val[0].decode('utf-8')
+        if channel == wake_key:
+            return []
+        tr = redis_conn.multi_exec()
+        tr.lrange(channel, -(self.LISTEN_CHUNK - 1), -1)
+        tr.ltrim(channel, 0, -self.LISTEN_CHUNK)
+        more, _ = yield from tr.execute()
+        values = [val[1]]
+        values.extend(reversed(more))
+        return [(channel, values)]
+
+    @asyncio.coroutine
+    def requeue(self, redis_conn, channel, values):
+        """Return values received by shared listener for channel which
+        has no WebSockets anymore back to the tail of channel queue.
+
+        :param values: Raw values from the oldest
+
+        """
+        yield from redis_conn.rpush(channel, *reversed(values))
+
+    @asyncio.coroutine
+    def wake_listener(self, wake_key, expire):
+        """Interrupt blocking :meth:`.receive_any` call by pushing to
+        listener wake key."""
+        pipe = self.conn.pipeline()
+        pipe.lpush(wake_key, '!')
+        pipe.expire(wake_key, expire)
+        yield from pipe.execute()
+
+
+class RedisQueueListener:
+    """Shared queue listener for all channels of the process.
+
+    Channels are spread over fixed number of Redis connections, every
+    connection is blocked with single call on all of its channels, see
+    :meth:`.RedisQueue.receive_any`. Channels are passed in random
+    order on every call, so channel with long queue doesn't starve the
+    others. When new channel is added, connection is woken up via its
+    own "wake" key, which is always listened as well. Removed channels
+    are dropped lazily on next call, so closing socket doesn't cost any
+    Redis writes. Values received for a channel which was removed
+    meanwhile are returned with :meth:`.RedisQueue.requeue`.
+
+    Received values are passed to :meth:`.RedisQueue.dispatch`, channel
+    with non writable WebSockets is paused until their buffers are
+    drained. Shard task survives Redis and dispatch errors: connection
+    is reopened after :attr:`.RESTART_DELAY` seconds, value received at
+    the moment of error may be lost, unless queue is reliable.
+
+    :param queue: :class:`.RedisQueue` instance
+    :param size: Number of Redis connections
+
+    """
+    WAKE_KEY = 'bachata:wake:%s'
+    WAKE_EXPIRE = 60
+    RESTART_DELAY = 1
+
+    def __init__(self, queue, size=4):
+        self.queue = queue
+        self.loop = queue.loop
+        self.size = size
+        self.shards = [set() for _ in range(size)]
+        self.wake_keys = [self.WAKE_KEY % uuid.uuid4().hex
+                          for _ in range(size)]
+        self.waking = [False] * size
+        self.paused = set()
+        self.tasks = []
+        self.conns = []
+
+    def start(self):
+        """Start listening tasks."""
+        for shard in range(self.size):
+            self.tasks.append(self.loop.create_task(self.listen(shard)))
+
+    def stop(self):
+        """Stop listening tasks and close connections."""
+        for task in self.tasks:
+            task.cancel()
+        for conn in self.conns:
+            conn.close()
+        self.tasks = []
+        self.conns = []
+
+    def add(self, channel):
+        """Start receiving messages for channel, WebSocket must be
+        registered in queue before the call."""
+        shard = self.get_shard(channel)
+        if channel not in self.shards[shard] and channel not in self.paused:
+            self.shards[shard].add(channel)
+            self.wake(shard)
+
+    def remove(self, channel):
+        """Remove channel if there are no WebSockets registered for it,
+        WebSocket must be unregistered from queue before the call."""
+        if channel not in self.queue.sockets:
+            self.shards[self.get_shard(channel)].discard(channel)
+
+    def get_shard(self, channel):
+        """Get connection number for channel."""
+        return hash(channel) % self.size
+
+    def wake(self, shard):
+        """Interrupt blocking call to update channels list."""
+        if not self.waking[shard]:
+            self.waking[shard] = True
+            self.loop.create_task(self.queue.wake_listener(
+                self.wake_keys[shard], self.WAKE_EXPIRE))
+
+    @asyncio.coroutine
+    def listen(self, shard):
+        """Listen for all channels of shard on single connection.
+
+        Shard is served by single task, so on any error connection is
+        reopened after :attr:`.RESTART_DELAY` instead of leaving all
+        shard channels without listener.
+
+        """
+        while True:
+            try:
+                yield from self._listen(shard)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Shard %s listener failed, restarting" % shard)
+                yield from asyncio.sleep(self.RESTART_DELAY, loop=self.loop)
+
+    @asyncio.coroutine
+    def _listen(self, shard):
+        redis_conn = yield from aioredis.create_redis(
+            loop=self.loop, **self.queue.conn_params)
+        self.conns.append(redis_conn)
+        try:
+            yield from self._listen_conn(redis_conn, shard)
+        finally:
+            redis_conn.close()
+            if redis_conn in self.conns:
+                self.conns.remove(redis_conn)
+
+    @asyncio.coroutine
+    def _listen_conn(self, redis_conn, shard):
+        wake_key = self.wake_keys[shard]
+        channels = self.shards[shard]
+
+        while True:
+            self.waking[shard] = False
+            # Blocking commands serve keys in arguments order
+            keys = list(channels)
+            random.shuffle(keys)
+            received = yield from self.queue.receive_any(
+                redis_conn, keys, wake_key)
+            log.debug("listen: %s" % (received,))
+
+            for channel, values in received:
+                websockets = self.queue.sockets.get(channel)
+                if not websockets:
+                    yield from self.queue.requeue(redis_conn, channel, values)
+                    continue
+                # Values received at once are all written, so buffers
+                # may exceed the limit by up to single chunk
+                websockets = list(websockets)
+                for value in values:
+                    yield from self.queue.dispatch(
+                        redis_conn, channel, value, websockets)
+                if not all(ws.is_writable() for ws in websockets):
+                    self.pause(channel, websockets)
+
+    def pause(self, channel, websockets):
+        """Stop listening channel until WebSockets outgoing
+        buffers are drained."""
+        shard = self.get_shard(channel)
+        self.shards[shard].discard(channel)
+        self.paused.add(channel)
+        self.loop.create_task(self._resume(channel, websockets, shard))
+
+    @asyncio.coroutine
+    def _resume(self, channel, websockets, shard):
+        try:
+            for websocket in websockets:
+                yield from websocket.wait_writable()
+        finally:
+            self.paused.discard(channel)
+        if channel in self.queue.sockets:
+            self.shards[shard].add(channel)
+            self.wake(shard)
+
 
 class ReliableRedisQueue(RedisQueue):
     """Reliable messages queue on top of Redis BRPOPLPUSH pattern.
@@ -129,7 +924,7 @@ class ReliableRedisQueue(RedisQueue):
     Storage schema description:
 
     1. Every message is stored as single value with key
-       "{channel}:{message id}" with expire time.
+       "{channel}:{message id}" with optional expire time.
 
     2. Incoming messages queue is represented via list of messages
        ids: [{message id 1}, {message id 2}, ...]
@@ -137,11 +932,328 @@ class ReliableRedisQueue(RedisQueue):
     3. Incoming queue key is "{channel}", waiting delivery confirmation
     queue key is "{channel}:wait"
 
+    4. Putting and popping messages is performed by Lua scripts,
+       so every operation is atomic and costs single round trip.
+
+    5. With ``message_expire`` specified messages keys and incoming
+       queues are expired, so undelivered messages don't stay forever.
+       With ``sweep_interval`` specified background task periodically
+       cleans up wait queues, see :meth:`.sweep`.
+
+    6. With ``shared_bodies`` enabled message sent to multiple channels
+       is stored once as hash with "body" and "refs" counter fields
+       under "bachata:body:{uuid}" key, and every "{channel}:{message id}"
+       key keeps reference: ['', {from channel}, {body key}]. Body is
+       removed when the last channel pops it or on expire.
+
+    7. With ``local_delivery`` enabled messages for channels listened
+       on this process are still stored and put on wait queue, but
+       are written to WebSockets directly instead of passing through
+       incoming queue.
+
+    8. Message for group is stored for every member on Redis side by
+       chunks, with ``shared_bodies`` enabled body is stored once for
+       the whole group, see :meth:`.put_group_message`.
+
+    9. With ``listener_conns`` specified putting message also pushes
+       value to "{channel}:ready" key if it's empty, and shared
+       listener blocks on these keys, so moving messages ids from
+       incoming queue to wait queue stays atomic, see
+       :meth:`.receive_any`.
+
     :param loop: asyncio event loop
     :param websocket: WebSocket handler instance
     :param conn_params: Redis connection params
+    :param listener_conns: Number of shared listener connections
+    :param message_expire: Message expire time in seconds
+    :param sweep_interval: Interval in seconds between wait queues sweeps
+    :param sweep_match: Keys pattern to find messages keys written
+                        without expire time, default is ``None``,
+                        so such keys are not searched
+    :param shared_bodies: Store message body once for all channels,
+                          default is ``False``
+    :param local_delivery: Deliver messages to local channels directly,
+                           default is ``False``
+    :param pubsub_types: Types of ephemeral messages delivered with
+                         Pub/Sub, see :class:`.RedisQueue`
+    :param pool_size: Max number of producer connections, see
+                      :class:`.RedisQueue`
 
     """
+    # KEYS: destination channels, local channels go first
+    # ARGV: message ID or empty string, message dump, from channel,
+    # expire time or 0, shared body key or empty string, number of
+    # local channels, notify flag
+    PUT_SCRIPT = RedisScript(LUA_PUT_MESSAGE, """
+        local expire = tonumber(ARGV[4])
+        local body_key = ARGV[5]
+        local local_count = tonumber(ARGV[6])
+        local notify = ARGV[7] == '1'
+        if ARGV[1] ~= '' and body_key ~= '' then
+            redis.call('HMSET', body_key, 'body', ARGV[2], 'refs', #KEYS)
+            if expire > 0 then
+                redis.call('EXPIRE', body_key, expire)
+            end
+        end
+        for i, channel in ipairs(KEYS) do
+            put_message(channel, ARGV[1], ARGV[2], ARGV[3],
+                        expire, body_key, i <= local_count, notify)
+        end
+        return #KEYS
+    """)
+
+    # KEYS: group key
+    # ARGV: SSCAN cursor, chunk size, message ID or empty string,
+    # message dump, from channel, expire time or 0, shared body key
+    # or empty string, notify flag
+    # Returns next SSCAN cursor.
+    GROUP_PUT_SCRIPT = RedisScript(LUA_PUT_MESSAGE, """
+        redis.replicate_commands()
+        local expire = tonumber(ARGV[6])
+        local body_key = ARGV[7]
+        local notify = ARGV[8] == '1'
+        local scan = redis.call('SSCAN', KEYS[1], ARGV[1],
+                                'COUNT', ARGV[2])
+        -- SSCAN may return member more than once, so members already
+        -- having message stored, i.e. by previous chunk, are skipped
+        local members, seen = {}, {}
+        for _, channel in ipairs(scan[2]) do
+            if not seen[channel] and (ARGV[3] == '' or
+                    redis.call('EXISTS', channel .. ':' .. ARGV[3]) == 0) then
+                members[#members + 1] = channel
+            end
+            seen[channel] = true
+        end
+        if body_key ~= '' then
+            -- Extra reference is held until the last chunk, so body
+            -- is not removed while members are still being added
+            if ARGV[1] == '0' then
+                redis.call('HMSET', body_key, 'body', ARGV[4], 'refs', 1)
+            end
+            redis.call('HINCRBY', body_key, 'refs', #members)
+            if expire > 0 then
+                redis.call('EXPIRE', body_key, expire)
+            end
+        end
+        for _, channel in ipairs(members) do
+            put_message(channel, ARGV[3], ARGV[4], ARGV[5],
+                        expire, body_key, false, notify)
+        end
+        if body_key ~= '' and scan[1] == '0' and
+           redis.call('HINCRBY', body_key, 'refs', -1) <= 0 then
+            redis.call('DEL', body_key)
+        end
+        return scan[1]
+    """)
+
+    # KEYS: wait queue, message keys
+    # Returns flat list of message dump and from channel pairs,
+    # pair of empty strings for missing message.
+    POP_SCRIPT = RedisScript("""
+        local result = {}
+        for i = 2, #KEYS do
+            local values = redis.call('LRANGE', KEYS[i], 0, 2)
+            local message_dump = values[1]
+            if values[1] == '' and values[3] then
+                message_dump = redis.call('HGET', values[3], 'body')
+                if redis.call('HINCRBY', values[3], 'refs', -1) <= 0 then
+                    redis.call('DEL', values[3])
+                end
+            end
+            if #values >= 2 then
+                redis.call('DEL', KEYS[i])
+                result[#result + 1] = message_dump or ''
+                result[#result + 1] = values[2]
+            else
+                result[#result + 1] = ''
+                result[#result + 1] = ''
+            end
+            redis.call('LREM', KEYS[1], 1, KEYS[i])
+        end
+        return result
+    """)
+
+    # KEYS: message key
+    GET_SCRIPT = RedisScript(LUA_MESSAGE_DUMP, """
+        return message_dump(KEYS[1])
+    """)
+
+    # KEYS: wait queue
+    # ARGV: page start and stop indexes, channel
+    # Returns number of examined values, number of removed values and
+    # messages dumps from the oldest. Values which are not channel
+    # messages keys or refer to missing messages are removed.
+    FETCH_SCRIPT = RedisScript(LUA_MESSAGE_DUMP, """
+        local values = redis.call('LRANGE', KEYS[1], ARGV[1], ARGV[2])
+        local prefix = ARGV[3] .. ':'
+        local result = {#values, 0}
+        for i = #values, 1, -1 do
+            local dump = false
+            if string.sub(values[i], 1, #prefix) == prefix then
+                dump = message_dump(values[i])
+            end
+            if dump then
+                result[#result + 1] = dump
+            else
+                redis.call('LREM', KEYS[1], 1, values[i])
+                result[2] = result[2] + 1
+            end
+        end
+        return result
+    """)
+
+    # KEYS: wait queue
+    # ARGV: page start and stop indexes, channel
+    # Returns number of examined values and number of removed values.
+    SWEEP_SCRIPT = RedisScript("""
+        local values = redis.call('LRANGE', KEYS[1], ARGV[1], ARGV[2])
+        local prefix = ARGV[3] .. ':'
+        local removed = 0
+        for i = #values, 1, -1 do
+            if string.sub(values[i], 1, #prefix) ~= prefix or
+               redis.call('EXISTS', values[i]) == 0 then
+                redis.call('LREM', KEYS[1], 1, values[i])
+                removed = removed + 1
+            end
+        end
+        return {#values, removed}
+    """)
+
+    # KEYS: keys to check
+    # ARGV: expire time
+    # Returns number of messages keys which got expire time.
+    EXPIRE_SCRIPT = RedisScript("""
+        local expired = 0
+        for _, key in ipairs(KEYS) do
+            if redis.call('TYPE', key)['ok'] == 'list' and
+               redis.call('TTL', key) == -1 and
+               redis.call('LLEN', key) == 2 then
+                redis.call('EXPIRE', key, ARGV[1])
+                expired = expired + 1
+            end
+        end
+        return expired
+    """)
+
+    # KEYS: incoming queue, wait queue, ready key
+    # ARGV: max number of values
+    # Returns values moved from incoming queue to wait queue, from the
+    # oldest. Ready key gets value again if incoming queue is not empty.
+    RECEIVE_SCRIPT = RedisScript("""
+        local result = {}
+        for _ = 1, tonumber(ARGV[1]) do
+            local value = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+            if not value then
+                break
+            end
+            result[#result + 1] = value
+        end
+        if redis.call('LLEN', KEYS[1]) > 0 and
+           redis.call('LLEN', KEYS[3]) == 0 then
+            redis.call('LPUSH', KEYS[3], '1')
+        end
+        return result
+    """)
+
+    SCRIPTS = (PUT_SCRIPT, GROUP_PUT_SCRIPT, POP_SCRIPT, GET_SCRIPT,
+               FETCH_SCRIPT, SWEEP_SCRIPT, EXPIRE_SCRIPT, RECEIVE_SCRIPT)
+
+    BODY_KEY = 'bachata:body:%s'
+
+    REPLAY_PAGE = 100
+
+    SWEEP_COUNT = 100
+
+    def __init__(self, loop=None, conn_params=None, listener_conns=None,
+                 message_expire=None, sweep_interval=None, sweep_match=None,
+                 shared_bodies=False, local_delivery=False,
+                 pubsub_types=None, pool_size=None):
+        super().__init__(loop=loop, conn_params=conn_params,
+                         listener_conns=listener_conns,
+                         local_delivery=local_delivery,
+                         pubsub_types=pubsub_types, pool_size=pool_size)
+        self.shared_bodies = shared_bodies
+        self.message_expire = message_expire
+        self.sweep_interval = sweep_interval
+        self.sweep_match = sweep_match
+        self.sweep_task = None
+        self.replays = {}
+
+    @asyncio.coroutine
+    def connect(self):
+        """Setup main Redis connection and start sweeping task."""
+        yield from super().connect()
+        if self.sweep_interval:
+            self.sweep_task = self.loop.create_task(self.sweep_forever())
+
+    @asyncio.coroutine
+    def close(self):
+        if self.sweep_task:
+            self.sweep_task.cancel()
+            self.sweep_task = None
+        yield from super().close()
+
+    @asyncio.coroutine
+    def sweep_forever(self):
+        """Run :meth:`.sweep` every ``sweep_interval`` seconds."""
+        while True:
+            yield from asyncio.sleep(self.sweep_interval, loop=self.loop)
+            try:
+                yield from self.sweep()
+            except aioredis.RedisError as e:
+                log.warning("Sweep failed: %s" % e)
+
+    @asyncio.coroutine
+    def sweep(self):
+        """Clean up messages storage incrementally.
+
+        Wait queues are found with SCAN and checked by pages, values
+        which are not messages keys or refer to expired messages are
+        removed. If ``sweep_match`` and ``message_expire`` are both
+        specified, then messages keys left without expire time get it.
+
+        Every step is a separate short command or script call, so
+        Redis is never blocked for long.
+
+        """
+        cursor = 0
+        while True:
+            cursor, keys = yield from self.conn.scan(
+                cursor, match='*:wait', count=self.SWEEP_COUNT)
+            for key in keys:
+                yield from self._sweep_wait_queue(key.decode('utf-8'))
+            if cursor in (0, b'0'):
+                break
+
+        if not (self.sweep_match and self.message_expire):
+            return
+
+        cursor = 0
+        while True:
+            cursor, keys = yield from self.conn.scan(
+                cursor, match=self.sweep_match, count=self.SWEEP_COUNT)
+            if keys:
+                yield from self.EXPIRE_SCRIPT.call(
+                    self.conn, keys=keys, args=(self.message_expire,))
+            if cursor in (0, b'0'):
+                break
+
+    @asyncio.coroutine
+    def _sweep_wait_queue(self, wait_queue):
+        """Remove trash values from wait queue by pages."""
+        channel = wait_queue[:-len(':wait')]
+        offset = 0
+        while True:
+            examined, removed = yield from self.SWEEP_SCRIPT.call(
+                self.conn, keys=[wait_queue],
+                args=(-(offset + self.REPLAY_PAGE), -(offset + 1), channel))
+            if removed:
+                log.debug("Removed %s trash values from %s" %
+                          (removed, wait_queue))
+            if examined < self.REPLAY_PAGE:
+                break
+            offset += examined - removed
+
     @asyncio.coroutine
     def put_message(self, channels, message, proto=None, from_channel=None):
         """Put messages on queue.
@@ -152,26 +1264,101 @@ class ReliableRedisQueue(RedisQueue):
         :param from_channel: Message from channel
 
         """
-        if isinstance(message, dict):
-            message_dump = proto.dump_message(message)
+        if self.is_ephemeral(message):
+            yield from self.publish(channels, message, proto=proto)
+            return
+
+        # If message is not dict itself, then just pass it as is.
+        if isinstance(message, (str, bytes)):
+            message_id = ''
+            queue_data = message
+        # Store every message which has ID within separate list,
+        # also store from channel with message as 2-nd list item.
         else:
-            message_dump = None
-
-        for channel in channels:
-            # Store every message which has ID within separate list,
-            # also store from channel with message as 2-nd list item.
-            if message_dump and ('id' in message):
-                message_key = '%s:%s' % (channel, message['id'])
-                queue_data = message_key
-                values = (message_dump, from_channel or '')
-                yield from self.conn.rpush(message_key, *values)
-            # If message has no ID or is not dict itself,
-            # then just pass it as is.
+            message_id = message.get('id', '')
+            queue_data = proto.dump_message(message)
+
+        local_channels = []
+        if self.local_delivery:
+            # Messages without ID don't need to be stored at all
+            if not message_id:
+                channels = self.write_local(channels, queue_data)
+                if not channels:
+                    return
             else:
-                queue_data = message_dump or message
+                local_channels = []
+                remote_channels = []
+                for channel in channels:
+                    if self.is_local_writable(channel):
+                        local_channels.append(channel)
+                    else:
+                        if channel in self.sockets:
+                            self.hold_local(
+                                channel, '%s:%s' % (channel, message_id))
+                        remote_channels.append(channel)
+                channels = local_channels + remote_channels
+
+        if self.shared_bodies and message_id and len(channels) > 1:
+            body_key = self.BODY_KEY % uuid.uuid4().hex
+        else:
+            body_key = ''
+
+        yield from self.PUT_SCRIPT.call(
+            self.conn, keys=channels,
+            args=(message_id, queue_data, from_channel or '',
+                  self.message_expire or 0, body_key, len(local_channels),
+                  int(bool(self.listener))))
+
+        # Local channels messages are put on wait queue only, so they
+        # are written regardless of buffers filled meanwhile, messages
+        # for WebSockets closed meanwhile are sent on reconnect
+        for channel in local_channels:
+            for websocket in self.sockets.get(channel, ()):
+                websocket.write_frame(queue_data)
+
+    @asyncio.coroutine
+    def put_group_message(self, group, message, proto=None,
+                          from_channel=None):
+        """Put message on queue for all group members.
+
+        Message is stored for members on Redis side by chunks of about
+        :attr:`.GROUP_CHUNK` members, see :meth:`.RedisQueue.put_group_message`.
+        Message with ID is stored for every member once, members which
+        already have message with the same ID stored are skipped.
+
+        :param group: :class:`.Group` instance or group name
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if self.is_ephemeral(message):
+            yield from base.BaseQueue.put_group_message(
+                self, group, message, proto=proto)
+            return
+
+        if isinstance(message, (str, bytes)):
+            message_id = ''
+            queue_data = message
+        else:
+            message_id = message.get('id', '')
+            queue_data = proto.dump_message(message)
 
-            # Put message ID or raw message on queue
-            yield from self.conn.lpush(channel, queue_data)
+        if self.shared_bodies and message_id:
+            body_key = self.BODY_KEY % uuid.uuid4().hex
+        else:
+            body_key = ''
+
+        group_key = self.GROUP_KEY % getattr(group, 'name', group)
+        cursor = 0
+        while True:
+            cursor = yield from self.GROUP_PUT_SCRIPT.call(
+                self.conn, keys=[group_key],
+                args=(cursor, self.GROUP_CHUNK, message_id, queue_data,
+                      from_channel or '', self.message_expire or 0,
+                      body_key, int(bool(self.listener))))
+            if int(cursor) == 0:
+                break
 
     @asyncio.coroutine
     def check_delivered(self, channel, message_id):
@@ -195,103 +1382,1005 @@ class ReliableRedisQueue(RedisQueue):
         :return: Tuple (delivered message, from channel)
 
         """
-        message_key = '%s:%s' % (channel, message_id)
+        delivered = yield from self.pop_delivered_many(
+            channel, [message_id], proto=proto)
+        if delivered:
+            return delivered[0]
+
+    @asyncio.coroutine
+    def pop_delivered_many(self, channel, message_ids, proto=None):
+        """Pop multiple delivered messages by IDs with single script call.
+
+        :param channel: Channel reveived messages
+        :param message_ids: List of messages IDs
+        :param proto: Messages protocol instance
+        :return: List of tuples (delivered message, from channel)
+
+        """
+        for acks in self.replays.get(channel, ()):
+            acks[0] += len(message_ids)
+
         wait_queue = '%s:wait' % channel
-        raw_message = yield from self.conn.lpop(message_key)
-        from_channel = yield from self.conn.lpop(message_key)
+        keys = [wait_queue]
+        keys.extend('%s:%s' % (channel, message_id)
+                    for message_id in message_ids)
+        values = yield from self.POP_SCRIPT.call(self.conn, keys=keys)
+
+        result = []
+        for raw_message, from_channel in zip(values[::2], values[1::2]):
+            if raw_message:
+                message = proto.load_message(raw_message)
+                result.append((message, from_channel.decode('utf-8')))
+        return result
+
+    @asyncio.coroutine
+    def attach(self, channel, websocket):
+        """Send wait queue to WebSocket first to deliver messages that
+        were not confirmed on previous session, and then start channel
+        listener, if it's not started yet.
 
-        yield from self.conn.lrem(wait_queue, 1, message_key)
+        WebSocket is registered before sending wait queue, so messages
+        written by listener meanwhile reach it as well and their
+        confirmations are expected from it, such messages may be sent
+        twice then.
 
-        if raw_message:
-            message = proto.load_message(raw_message.decode('utf-8'))
-            return message, from_channel.decode('utf-8')
+        """
+        if websocket.is_closed:
+            return
+        self.register(channel, websocket)
+        wait_queue = '%s:wait' % channel
+        yield from self._send_wait_queue(
+            wait_queue, self.conn, channel, websocket)
+        if channel in self.sockets:
+            if self.listener:
+                # Messages put without notify, i.e. while channel was
+                # popped by listener of another process, are picked up
+                yield from self.RECEIVE_SCRIPT.call(
+                    self.conn, keys=[channel, wait_queue,
+                                     '%s:ready' % channel], args=(0,))
+            self.start_listening(channel)
 
     @asyncio.coroutine
-    def listen_queue(self, channel, websocket):
-        """Start queue listener for channel and WebSocket connection.
+    def listen_queue(self, channel):
+        """Start queue listener for channel.
 
-        Send wait queue first to deliver messages that was not delivered
-        on previous session. Then start listening for new messages. Every
-        message with ID is send through WebSocket and put on wait queue.
-        After delivery confirmation message is removed from wait queue,
-        see :meth:`.pop_delivered` method.
+        Every message with ID is sent to all channel WebSockets and put
+        on wait queue. After delivery confirmation message is removed
+        from wait queue, see :meth:`.pop_delivered` method.
 
         """
         redis_conn = yield from aioredis.create_redis(
             loop=self.loop, **self.conn_params)
-
-        # Send wait queue first
         wait_queue = '%s:wait' % channel
-        yield from self._send_wait_queue(
-            wait_queue, redis_conn, channel, websocket)
+        try:
+            # Message popped right before cancel stays on wait queue
+            # until next session
+            while True:
+                yield from self.wait_writable(channel)
+                raw = yield from redis_conn.brpoplpush(
+                    channel, wait_queue)
+
+                log.debug("listen_queue: %s" % raw)
+
+                if raw:
+                    yield from self.dispatch(
+                        redis_conn, channel, raw,
+                        list(self.sockets.get(channel, ())))
+        finally:
+            redis_conn.close()
 
-        # Wait for new messages and send
-        while True:
-            raw = yield from redis_conn.brpoplpush(
-                channel, wait_queue)
+    @asyncio.coroutine
+    def receive_any(self, redis_conn, channels, wake_key):
+        """Wait for messages on any of channels, used by shared listener.
 
-            log.debug("listen_queue: %s" % raw)
+        Listener blocks with BRPOP on channels "ready" keys, then
+        up to :attr:`.LISTEN_CHUNK` values are moved from incoming
+        queue to wait queue by single script call, so messages popped
+        right before failure stay on wait queue until next session.
 
-            if not raw:
-                continue
+        """
+        keys = ['%s:ready' % channel for channel in channels]
+        keys.append(wake_key)
+        val = yield from redis_conn.brpop(*keys, timeout=0)
+        if not val:
+            return []
+        key = val[0].decode('utf-8')
+        if key == wake_key:
+            return []
+        channel = key[:-len(':ready')]
+        values = yield from self.RECEIVE_SCRIPT.call(
+            redis_conn, keys=[channel, '%s:wait' % channel, key],
+            args=(self.LISTEN_CHUNK,))
+        return [(channel, values)]
 
-            val = raw.decode('utf-8')
+    @asyncio.coroutine
+    def dispatch(self, redis_conn, channel, raw, websockets):
+        """Write value moved to wait queue by listener, values which are
+        not messages keys don't need confirmation and are removed from
+        wait queue right away.
 
-            if val == self.CLOSE_COMMAND:
-                yield from redis_conn.lrem(wait_queue, 0, self.CLOSE_COMMAND)
-                redis_conn.close()
-                return
-            else:
-                pop_wait = yield from self._write_message(
-                    redis_conn, val, channel, websocket)
-                if pop_wait:
-                    yield from redis_conn.lpop(wait_queue)
+        Value is removed with LREM, as local messages keys may be put on
+        the head of wait queue after it meanwhile.
+
+        """
+        pop_wait = yield from self._write_message(
+            redis_conn, raw, channel, websockets)
+        if self.held:
+            self.release_local(channel, raw)
+        if pop_wait:
+            yield from redis_conn.lrem('%s:wait' % channel, 1, raw)
+
+    @asyncio.coroutine
+    def requeue(self, redis_conn, channel, values):
+        """Values are already on wait queue and are sent on next
+        session, see :meth:`.attach`."""
 
     @asyncio.coroutine
     def _send_wait_queue(self, wait_queue, redis_conn, channel, websocket):
         """Send messages from waiting queue.
 
+        Messages are fetched by pages of :attr:`.REPLAY_PAGE` size,
+        every page costs single script call and is written to WebSocket
+        right after it's received.
+
         :param wait_queue: Wait queue key
         :param redis_conn: Redis connection
         :param channel: Message channel
         :param websocket: WebSocket connection
 
         """
-        wait_messages = yield from redis_conn.lrange(wait_queue, 0, -1)
-        for raw in reversed(wait_messages):
-            val = raw.decode('utf-8')
-            if val.startswith(channel):
-                yield from self._write_message(
-                    redis_conn, val, channel, websocket)
+        # Wait queue is read from the tail (oldest messages) by pages
+        # with negative indexes, so messages put on the head meanwhile
+        # don't shift the pages. Confirmations received during replay
+        # do shift them, so they are counted to adjust offset.
+        acks = [0]
+        self.replays.setdefault(channel, []).append(acks)
+        try:
+            offset = 0
+            while True:
+                writable = yield from websocket.wait_writable()
+                if not writable:
+                    return
+                # Confirmations counted before popping, so adjusting right
+                # before fetch accounts all of them executed before it
+                offset = max(0, offset - acks[0])
+                acks[0] = 0
+                values = yield from self.FETCH_SCRIPT.call(
+                    redis_conn, keys=[wait_queue],
+                    args=(-(offset + self.REPLAY_PAGE), -(offset + 1),
+                          channel))
+                examined, removed = values[0], values[1]
+                if removed:
+                    log.warning("Removed %s trash values from %s" %
+                                (removed, wait_queue))
+
+                for message_dump in values[2:]:
+                    if websocket.is_closed:
+                        return
+                    websocket.write_frame(message_dump)
+
+                if examined < self.REPLAY_PAGE:
+                    break
+                offset += examined - removed
+        finally:
+            replays = [a for a in self.replays[channel] if a is not acks]
+            if replays:
+                self.replays[channel] = replays
             else:
-                # Actually we should not be here, if everything works fine!
-                # But due to [old] bugs there could be trash messages on wait
-                # queue, so we just clean them up.
-                # TODO: place WARNING here
-                yield from self.conn.lrem(wait_queue, 1, val)
+                del self.replays[channel]
 
     @asyncio.coroutine
-    def _write_message(self, redis_conn, msg_or_id, channel, websocket):
-        """Write message to WebSocket output by ID or raw value.
+    def _write_message(self, redis_conn, msg_or_id, channel, websockets):
+        """Write message to WebSockets output by ID or raw value.
 
         Messages with confirmation are stored separatelly
         and only their id is passed to queue. Messages
         without delivery confirmation are just sent as is.
 
         :param redis_conn: Redis connection
-        :param msg_or_id: Message ID or dump to str
+        :param msg_or_id: Message key or dump as bytes
         :param channel: Message channel
-        :param websocket: WebSocket connection
+        :param websockets: List of WebSocket connections
         :return: `True` if message should be removed from wait
                  queue, because doesn't need confirmation.
 
         """
         # get by id and send
-        if msg_or_id.startswith(channel):
-            message_dump = yield from redis_conn.lindex(msg_or_id, 0)
+        if msg_or_id.startswith(channel.encode('utf-8')):
+            message_dump = yield from self.GET_SCRIPT.call(
+                redis_conn, keys=[msg_or_id])
             if message_dump:
-                websocket.write_message(message_dump)
+                for websocket in websockets:
+                    websocket.write_frame(message_dump)
         # just send
         else:
-            websocket.write_message(msg_or_id)
+            for websocket in websockets:
+                websocket.write_frame(msg_or_id)
             return True
+
+
+class StreamRedisQueue(RedisQueue):
+    """Reliable messages queue on top of Redis Streams, requires Redis 5.0+.
+
+    Storage schema description:
+
+    1. Messages are added with XADD to stream with "{channel}:stream"
+       key, stream length is capped approximately by ``stream_maxlen``.
+       Every entry has "id", "body" and "from" fields.
+
+    2. Receiver reads stream with XREADGROUP in "bachata" consumer
+       group. Stream belongs to single channel, so all streams are
+       read by the same "bachata" consumer, and entries pending on
+       previous session are redelivered on next connection. Stream is
+       read once per process and entries are written to all channel
+       WebSockets, every new WebSocket gets pending entries.
+
+    3. Messages IDs are mapped to entries IDs with hash stored
+       under "{channel}:stream:ids" key. On delivery confirmation entry
+       is acknowledged with XACK and removed with XDEL.
+
+    4. Messages without ID don't need confirmation, so they are
+       acknowledged right after sending.
+
+    5. Entries trimmed by ``stream_maxlen`` are lost, their mapping
+       fields are removed from "{channel}:stream:ids" when hash grows
+       over twice ``stream_maxlen``.
+
+    6. With ``stream_expire`` specified stream and its IDs hash are
+       expired, so streams of channels which never connect don't stay
+       forever. Consumer group is recreated on next read.
+
+    7. With ``listener_conns`` specified shared listener reads streams
+       of all its channels with single XREADGROUP call, along with its
+       own "wake" stream, see :meth:`.receive_any`.
+
+    :param loop: asyncio event loop
+    :param conn_params: Redis connection params
+    :param listener_conns: Number of shared listener connections
+    :param stream_maxlen: Approximate max stream length
+    :param stream_expire: Stream expire time in seconds, default is
+                          ``None``, so streams never expire
+    :param read_count: Max number of entries per XREADGROUP call
+    :param pubsub_types: Types of ephemeral messages delivered with
+                         Pub/Sub, see :class:`.RedisQueue`
+    :param pool_size: Max number of producer connections, see
+                      :class:`.RedisQueue`
+
+    """
+    GROUP = 'bachata'
+
+    CONSUMER = 'bachata'
+
+    WAKE_MAXLEN = 10
+
+    # KEYS: destination channels streams
+    # ARGV: message ID or empty string, message dump, from channel,
+    # max stream length, expire time or 0
+    PUT_SCRIPT = RedisScript("""
+        local function parse_id(entry_id)
+            local ms, seq = string.match(entry_id, '(%d+)-(%d+)')
+            return tonumber(ms), tonumber(seq)
+        end
+
+        local function clean_ids(stream, ids_key)
+            local first = redis.call('XRANGE', stream, '-', '+', 'COUNT', 1)
+            local first_ms, first_seq = math.huge, 0
+            if first[1] then
+                first_ms, first_seq = parse_id(first[1][1])
+            end
+            local fields = redis.call('HGETALL', ids_key)
+            for i = 1, #fields, 2 do
+                local ms, seq = parse_id(fields[i + 1])
+                if ms < first_ms or (ms == first_ms and seq < first_seq) then
+                    redis.call('HDEL', ids_key, fields[i])
+                end
+            end
+        end
+
+        local maxlen = tonumber(ARGV[4])
+        local expire = tonumber(ARGV[5])
+        for _, stream in ipairs(KEYS) do
+            local ids_key = stream .. ':ids'
+            local entry_id = redis.call('XADD', stream,
+                'MAXLEN', '~', maxlen, '*',
+                'id', ARGV[1], 'body', ARGV[2], 'from', ARGV[3])
+            if ARGV[1] ~= '' then
+                redis.call('HSET', ids_key, ARGV[1], entry_id)
+                if redis.call('HLEN', ids_key) > 2 * maxlen then
+                    clean_ids(stream, ids_key)
+                end
+            end
+            if expire > 0 then
+                redis.call('EXPIRE', stream, expire)
+                redis.call('EXPIRE', ids_key, expire)
+            end
+        end
+        return #KEYS
+    """)
+
+    # KEYS: stream, messages IDs hash
+    # ARGV: consumer group, messages IDs
+    # Returns flat list of message dump and from channel pairs,
+    # pair of empty strings for missing message.
+    POP_SCRIPT = RedisScript("""
+        local result = {}
+        for i = 2, #ARGV do
+            local message_id = ARGV[i]
+            local entry_id = redis.call('HGET', KEYS[2], message_id)
+            local message_dump, from_channel = '', ''
+            if entry_id then
+                local entries = redis.call('XRANGE', KEYS[1],
+                                           entry_id, entry_id)
+                if entries[1] then
+                    local fields = entries[1][2]
+                    for i = 1, #fields, 2 do
+                        if fields[i] == 'body' then
+                            message_dump = fields[i + 1]
+                        elseif fields[i] == 'from' then
+                            from_channel = fields[i + 1]
+                        end
+                    end
+                end
+                redis.call('XACK', KEYS[1], ARGV[1], entry_id)
+                redis.call('XDEL', KEYS[1], entry_id)
+                redis.call('HDEL', KEYS[2], message_id)
+            end
+            result[#result + 1] = message_dump
+            result[#result + 1] = from_channel
+        end
+        return result
+    """)
+
+    # KEYS: stream
+    # ARGV: consumer group, entries IDs
+    ACK_SCRIPT = RedisScript("""
+        local group = table.remove(ARGV, 1)
+        redis.call('XACK', KEYS[1], group, unpack(ARGV))
+        return redis.call('XDEL', KEYS[1], unpack(ARGV))
+    """)
+
+    SCRIPTS = (PUT_SCRIPT, POP_SCRIPT, ACK_SCRIPT)
+
+    def __init__(self, loop=None, conn_params=None, listener_conns=None,
+                 stream_maxlen=10000, stream_expire=None, read_count=100,
+                 pubsub_types=None, pool_size=None):
+        super().__init__(loop=loop, conn_params=conn_params,
+                         listener_conns=listener_conns,
+                         pubsub_types=pubsub_types, pool_size=pool_size)
+        self.stream_maxlen = stream_maxlen
+        self.stream_expire = stream_expire
+        self.read_count = read_count
+
+    @asyncio.coroutine
+    def put_message(self, channels, message, proto=None, from_channel=None):
+        """Put messages on queue.
+
+        :param channels: List of destination channels
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if self.is_ephemeral(message):
+            yield from self.publish(channels, message, proto=proto)
+            return
+
+        if isinstance(message, (str, bytes)):
+            message_id = ''
+            message_dump = message
+        else:
+            message_id = message.get('id', '')
+            message_dump = proto.dump_message(message)
+
+        streams = ['%s:stream' % channel for channel in channels]
+        yield from self.PUT_SCRIPT.call(
+            self.conn, keys=streams,
+            args=(message_id, message_dump, from_channel or '',
+                  self.stream_maxlen, self.stream_expire or 0))
+
+    @asyncio.coroutine
+    def put_group_message(self, group, message, proto=None,
+                          from_channel=None):
+        """Put message on queue for all group members, members are
+        fetched and message is added to their streams by chunks, see
+        :meth:`.BaseQueue.put_group_message`.
+
+        """
+        yield from base.BaseQueue.put_group_message(
+            self, group, message, proto=proto, from_channel=from_channel)
+
+    @asyncio.coroutine
+    def check_delivered(self, channel, message_id):
+        """Check if message is delivered."""
+        pending = yield from self.conn.hexists(
+            '%s:stream:ids' % channel, message_id)
+        return not pending
+
+    @asyncio.coroutine
+    def pop_delivered(self, channel, message_id, proto=None):
+        """Pop delivered message by ID.
+
+        :param channel: Channel reveived message
+        :param message_id: Message ID
+        :param proto: Messages protocol instance
+        :return: Tuple (delivered message, from channel)
+
+        """
+        delivered = yield from self.pop_delivered_many(
+            channel, [message_id], proto=proto)
+        if delivered:
+            return delivered[0]
+
+    @asyncio.coroutine
+    def pop_delivered_many(self, channel, message_ids, proto=None):
+        """Acknowledge and remove delivered stream entries by messages IDs.
+
+        :param channel: Channel reveived messages
+        :param message_ids: List of messages IDs
+        :param proto: Messages protocol instance
+        :return: List of tuples (delivered message, from channel)
+
+        """
+        stream = '%s:stream' % channel
+        values = yield from self.POP_SCRIPT.call(
+            self.conn, keys=(stream, '%s:ids' % stream),
+            args=[self.GROUP] + list(message_ids))
+
+        result = []
+        for raw_message, from_channel in zip(values[::2], values[1::2]):
+            if raw_message:
+                message = proto.load_message(raw_message)
+                result.append((message, from_channel.decode('utf-8')))
+        return result
+
+    @asyncio.coroutine
+    def attach(self, channel, websocket):
+        """Send entries pending since previous session to WebSocket
+        first, and then start channel listener, if it's not started yet.
+
+        WebSocket is registered before sending pending entries, see
+        :meth:`.ReliableRedisQueue.attach`.
+
+        """
+        if websocket.is_closed:
+            return
+        self.register(channel, websocket)
+        stream = '%s:stream' % channel
+        yield from self._create_group(self.conn, stream)
+
+        last_id = '0'
+        while True:
+            writable = yield from websocket.wait_writable()
+            if not writable:
+                return
+            entries = yield from self._read_group(
+                self.conn, stream, last_id)
+            if not entries:
+                break
+            last_id = entries[-1][0]
+            yield from self._write_entries(
+                self.conn, stream, entries, [websocket])
+
+        if channel in self.sockets:
+            self.start_listening(channel)
+
+    @asyncio.coroutine
+    def listen_queue(self, channel):
+        """Start queue listener for channel, new entries are written
+        to all channel WebSockets."""
+        redis_conn = yield from aioredis.create_redis(
+            loop=self.loop, **self.conn_params)
+        stream = '%s:stream' % channel
+        try:
+            # Entries read right before cancel stay pending until
+            # next session
+            while True:
+                yield from self.wait_writable(channel)
+                try:
+                    entries = yield from self._read_group(
+                        redis_conn, stream, '>', block=0)
+                except aioredis.ReplyError as e:
+                    # Stream is expired or deleted while listening
+                    if not str(e).startswith(('NOGROUP', 'UNBLOCKED')):
+                        raise
+                    yield from self._create_group(redis_conn, stream)
+                    continue
+                log.debug("listen_queue: %s" % entries)
+                yield from self._write_entries(
+                    redis_conn, stream, entries,
+                    list(self.sockets.get(channel, ())))
+        finally:
+            redis_conn.close()
+
+    @asyncio.coroutine
+    def receive_any(self, redis_conn, channels, wake_key):
+        """Read new entries of all channels streams and listener wake
+        stream with single XREADGROUP call, used by shared listener.
+
+        Consumer groups missing for expired or deleted streams are
+        created and the call is repeated by listener.
+
+        """
+        streams = ['%s:stream' % channel for channel in channels]
+        streams.append(wake_key)
+        try:
+            received = yield from self._read_streams(
+                redis_conn, streams, ['>'] * len(streams), block=0)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith(('NOGROUP', 'UNBLOCKED')):
+                raise
+            for stream in streams:
+                yield from self._create_group(redis_conn, stream)
+            yield from redis_conn.expire(
+                wake_key, RedisQueueListener.WAKE_EXPIRE)
+            return []
+
+        result = []
+        for stream, entries in received:
+            if stream == wake_key:
+                yield from self.ACK_SCRIPT.call(
+                    redis_conn, keys=[stream],
+                    args=[self.GROUP] + [e[0] for e in entries])
+            else:
+                result.append((stream[:-len(':stream')], entries))
+        return result
+
+    @asyncio.coroutine
+    def dispatch(self, redis_conn, channel, entry, websockets):
+        """Write entry received by shared listener."""
+        yield from self._write_entries(
+            redis_conn, '%s:stream' % channel, [entry], websockets)
+
+    @asyncio.coroutine
+    def requeue(self, redis_conn, channel, entries):
+        """Entries stay pending and are sent on next session, see
+        :meth:`.attach`."""
+
+    @asyncio.coroutine
+    def wake_listener(self, wake_key, expire):
+        """Interrupt blocking :meth:`.receive_any` call by adding entry
+        to listener wake stream."""
+        pipe = self.conn.pipeline()
+        pipe.execute('XADD', wake_key, 'MAXLEN', '~', self.WAKE_MAXLEN,
+                     '*', 'wake', '!')
+        pipe.expire(wake_key, expire)
+        yield from pipe.execute()
+
+    @asyncio.coroutine
+    def _create_group(self, redis_conn, stream):
+        """Create consumer group with stream, if not exists."""
+        try:
+            yield from redis_conn.execute(
+                'XGROUP', 'CREATE', stream, self.GROUP, '0', 'MKSTREAM')
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    @asyncio.coroutine
+    def _read_group(self, redis_conn, stream, last_id, block=None):
+        """Read entries of single stream with XREADGROUP.
+
+        :return: List of tuples (entry ID, fields dict)
+
+        """
+        received = yield from self._read_streams(
+            redis_conn, [stream], [last_id], block=block)
+        return received[0][1] if received else []
+
+    @asyncio.coroutine
+    def _read_streams(self, redis_conn, streams, last_ids, block=None):
+        """Read entries of multiple streams with XREADGROUP.
+
+        :return: List of tuples (stream, list of entries), every entry
+                 is tuple (entry ID, fields dict)
+
+        """
+        args = ['GROUP', self.GROUP, self.CONSUMER,
+                'COUNT', self.read_count]
+        if block is not None:
+            args.extend(('BLOCK', block))
+        args.append('STREAMS')
+        args.extend(streams)
+        args.extend(last_ids)
+        reply = yield from redis_conn.execute('XREADGROUP', *args)
+
+        received = []
+        for stream, stream_entries in (reply or ()):
+            entries = []
+            for entry_id, fields in stream_entries:
+                # Pending entries already deleted are returned empty
+                if fields:
+                    fields = dict(zip(fields[::2], fields[1::2]))
+                entries.append((entry_id, fields or {}))
+            received.append((stream.decode('utf-8'), entries))
+        return received
+
+    @asyncio.coroutine
+    def _write_entries(self, redis_conn, stream, entries, websockets):
+        """Write entries to WebSockets output.
+
+        Entries without message ID are acknowledged and removed
+        right after sending.
+
+        """
+        done = []
+        for entry_id, fields in entries:
+            body = fields.get(b'body')
+            if not fields.get(b'id'):
+                done.append(entry_id)
+            if body:
+                for websocket in websockets:
+                    websocket.write_frame(body)
+
+        if done:
+            yield from self.ACK_SCRIPT.call(
+                redis_conn, keys=[stream], args=[self.GROUP] + done)
+
+
+class NodeRedisQueue(RedisQueue):
+    """Messages queue with single incoming list per server node.
+
+    Schema description:
+
+    1. Every node has unique ``node_id`` and "bachata:node:{node id}"
+       key refreshed with expire time every ``node_ttl / 3`` seconds
+       while node is alive.
+
+    2. When the first WebSocket for channel connects to node, node ID
+       is added to "bachata:nodes:{channel}" set, so channel may be
+       listened by multiple nodes, i.e. user devices connected to
+       different nodes.
+
+    3. Messages for channel are LPUSH'ed to inboxes of all its alive
+       nodes, inbox is "bachata:inbox:{node id}" list and values are
+       prefixed with channel name. Messages are written to WebSockets
+       by node itself. Every node listens only its inbox with BRPOP,
+       so there is single blocking Redis connection per node, not per
+       WebSocket.
+
+    4. Messages for offline channels are LPUSH'ed to "{channel}" list
+       as in :class:`.RedisQueue` and are sent on next connection. Same
+       is done for messages which node has received for channel closed
+       meanwhile, or for WebSockets which have full outgoing buffer.
+
+    5. Dead nodes are removed from channels sets by senders, and dead
+       node inbox is moved back to channels lists by chunks of
+       :attr:`.REQUEUE_CHUNK` values, so messages are sent on next
+       connection. Messages also delivered via other nodes may be sent
+       twice then. Node which has missed heartbeats maps its channels
+       again on next heartbeat.
+
+    :param loop: asyncio event loop
+    :param conn_params: Redis connection params
+    :param node_id: Unique node identifier, default is random UUID
+    :param node_ttl: Time in seconds for node to be considered alive
+                     after the last heartbeat
+    :param local_delivery: Deliver messages to local channels directly,
+                           default is ``False``
+    :param pubsub_types: Types of ephemeral messages delivered with
+                         Pub/Sub, see :class:`.RedisQueue`
+    :param pool_size: Max number of producer connections, see
+                      :class:`.RedisQueue`
+
+    """
+    NODES_KEY = 'bachata:nodes:%s'
+
+    NODE_KEY = 'bachata:node:%s'
+
+    INBOX_KEY = 'bachata:inbox:%s'
+
+    # KEYS: destination channels
+    # ARGV: message dump, channel nodes key format, node key format,
+    # inbox key format, max number of values requeued from dead inbox
+    # Inbox values are "{channel length}:{channel}{message dump}".
+    NODE_PUT_SCRIPT = RedisScript("""
+        -- Move values from dead node inbox back to channels lists,
+        -- returns true when inbox is empty
+        local function requeue(inbox, count)
+            for _ = 1, count do
+                local data = redis.call('RPOP', inbox)
+                if not data then
+                    return true
+                end
+                local sep = string.find(data, ':', 1, true)
+                local size = tonumber(string.sub(data, 1, sep - 1))
+                redis.call('LPUSH', string.sub(data, sep + 1, sep + size),
+                           string.sub(data, sep + size + 1))
+            end
+            return redis.call('EXISTS', inbox) == 0
+        end
+
+        local requeue_count = tonumber(ARGV[5])
+        for _, channel in ipairs(KEYS) do
+            local nodes_key = string.format(ARGV[2], channel)
+            local sent = false
+            for _, node in ipairs(redis.call('SMEMBERS', nodes_key)) do
+                local inbox = string.format(ARGV[4], node)
+                if redis.call('EXISTS',
+                              string.format(ARGV[3], node)) == 1 then
+                    redis.call('LPUSH', inbox, string.len(channel) ..
+                               ':' .. channel .. ARGV[1])
+                    sent = true
+                elseif requeue(inbox, requeue_count) then
+                    redis.call('SREM', nodes_key, node)
+                end
+            end
+            if not sent then
+                redis.call('LPUSH', channel, ARGV[1])
+            end
+        end
+        return #KEYS
+    """)
+
+    SCRIPTS = (NODE_PUT_SCRIPT,)
+
+    RESUME_CHUNK = 100
+
+    REQUEUE_CHUNK = 100
+
+    RESTART_DELAY = 1
+
+    def __init__(self, loop=None, conn_params=None, listener_conns=None,
+                 node_id=None, node_ttl=30, local_delivery=False,
+                 pubsub_types=None, pool_size=None):
+        assert not listener_conns, ("Error, shared listener is not "
+                                    "supported for node inbox queue.")
+        super().__init__(loop=loop, conn_params=conn_params,
+                         local_delivery=local_delivery,
+                         pubsub_types=pubsub_types, pool_size=pool_size)
+        self.node_id = node_id or uuid.uuid4().hex
+        self.node_ttl = node_ttl
+        self.node_key = self.NODE_KEY % self.node_id
+        self.inbox_key = self.INBOX_KEY % self.node_id
+        self.paused = set()
+        self.pushes = {}
+        self.tasks = []
+        self.inbox_conn = None
+
+    def add_socket(self, channel, websocket, proto=None):
+        """Register WebSocket for receiving messages from channel.
+
+        :param channel: String channel identifier, based on user id or some hash string
+        :param websocket: Tornado WebSocket handler instance
+        :param proto: Messages protocol instance
+
+        """
+        websocket.is_closed = False
+        websocket.write_transport(proto.TRANS_READY)
+        if self.register(channel, websocket):
+            self.loop.create_task(self.map_channel(channel))
+
+    def del_socket(self, channel, websocket, proto=None):
+        """Unregister WebSocket from receiving messages from channel.
+
+        :param channel: String channel identifier, based on user id or some hash string
+        :param websocket: Tornado WebSocket handler instance
+        :param proto: Messages protocol instance
+
+        """
+        websocket.is_closed = True
+        if self.unregister(channel, websocket):
+            self.loop.create_task(self.unmap_channel(channel))
+
+    @asyncio.coroutine
+    def connect(self):
+        """Setup main Redis connection, start heartbeat and inbox
+        listening tasks."""
+        yield from super().connect()
+        yield from self.heartbeat()
+        self.inbox_conn = yield from aioredis.create_redis(
+            loop=self.loop, **self.conn_params)
+        self.tasks = [self.loop.create_task(self.heartbeat_forever()),
+                      self.loop.create_task(self.listen_inbox())]
+
+    @asyncio.coroutine
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.inbox_conn:
+            self.inbox_conn.close()
+            self.inbox_conn = None
+        # Senders fall back to channels queues right away
+        yield from self.conn.delete(self.node_key)
+        yield from super().close()
+
+    @asyncio.coroutine
+    def heartbeat(self):
+        """Mark node as alive for ``node_ttl`` seconds.
+
+        If node key is expired meanwhile, node could be removed from
+        channels sets by senders, so channels are mapped again and
+        messages put on their queues are sent.
+
+        """
+        alive = yield from self.conn.expire(self.node_key, self.node_ttl)
+        if alive:
+            return
+        yield from self.conn.set(self.node_key, '1', expire=self.node_ttl)
+        channels = list(self.sockets)
+        if channels:
+            pipe = self.conn.pipeline()
+            for channel in channels:
+                pipe.sadd(self.NODES_KEY % channel, self.node_id)
+            yield from pipe.execute()
+            for channel in channels:
+                if channel not in self.paused:
+                    self.pause(channel)
+
+    @asyncio.coroutine
+    def heartbeat_forever(self):
+        """Run :meth:`.heartbeat` every ``node_ttl / 3`` seconds."""
+        while True:
+            yield from asyncio.sleep(self.node_ttl / 3, loop=self.loop)
+            try:
+                yield from self.heartbeat()
+            except aioredis.RedisError as e:
+                log.warning("Heartbeat failed: %s" % e)
+
+    @asyncio.coroutine
+    def put_message(self, channels, message, proto=None, from_channel=None):
+        """Put messages on queue.
+
+        Messages for all channels are sent with single script call.
+
+        :param channels: List of destination channels
+        :param message: Message dict object
+        :param proto: Messages protocol instance
+        :param from_channel: Message from channel
+
+        """
+        if self.is_ephemeral(message):
+            yield from self.publish(channels, message, proto=proto)
+            return
+
+        if isinstance(message, (str, bytes)):
+            raw_message = message
+        else:
+            raw_message = proto.dump_message(message)
+
+        if self.local_delivery:
+            channels = self.write_local(channels, raw_message)
+            if not channels:
+                return
+
+        yield from self.NODE_PUT_SCRIPT.call(
+            self.conn, keys=channels,
+            args=(raw_message, self.NODES_KEY, self.NODE_KEY,
+                  self.INBOX_KEY, self.REQUEUE_CHUNK))
+
+    @asyncio.coroutine
+    def put_group_message(self, group, message, proto=None,
+                          from_channel=None):
+        """Put message on queue for all group members, members are
+        fetched and message is put by chunks, see
+        :meth:`.BaseQueue.put_group_message`.
+
+        """
+        yield from base.BaseQueue.put_group_message(
+            self, group, message, proto=proto, from_channel=from_channel)
+
+    @asyncio.coroutine
+    def map_channel(self, channel):
+        """Map channel to this node and send messages stored while
+        channel was offline."""
+        yield from self.conn.sadd(self.NODES_KEY % channel, self.node_id)
+        self.paused.add(channel)
+        yield from self._resume(channel)
+
+    @asyncio.coroutine
+    def unmap_channel(self, channel):
+        """Remove this node from channel nodes, if channel is still
+        not listened on this node."""
+        if channel not in self.sockets:
+            nodes_key = self.NODES_KEY % channel
+            yield from self.conn.srem(nodes_key, self.node_id)
+            # Commands may go over different pool connections, so
+            # mapping is restored if channel was attached meanwhile
+            if channel in self.sockets:
+                yield from self.conn.sadd(nodes_key, self.node_id)
+
+    @asyncio.coroutine
+    def listen_inbox(self):
+        """Listen node inbox and write messages to WebSockets.
+
+        Inbox listener is the only consumer of node messages, while
+        heartbeat keeps node alive for senders, so on any error inbox
+        connection is reopened after :attr:`.RESTART_DELAY` seconds.
+
+        """
+        while True:
+            try:
+                if self.inbox_conn is None:
+                    self.inbox_conn = yield from aioredis.create_redis(
+                        loop=self.loop, **self.conn_params)
+                yield from self._listen_inbox(self.inbox_conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Node inbox listener failed, restarting")
+                if self.inbox_conn:
+                    self.inbox_conn.close()
+                    self.inbox_conn = None
+                yield from asyncio.sleep(self.RESTART_DELAY, loop=self.loop)
+
+    @asyncio.coroutine
+    def _listen_inbox(self, inbox_conn):
+        while True:
+            val = yield from inbox_conn.brpop(self.inbox_key, timeout=0)
+            log.debug("listen_inbox: %s" % (val,))
+            if not val:
+                continue
+
+            data = val[1]
+            sep = data.index(b':')
+            end = sep + 1 + int(data[:sep])
+            channel, raw = data[sep + 1:end].decode('utf-8'), data[end:]
+
+            websockets = self.sockets.get(channel)
+            if websockets and (channel not in self.paused):
+                for websocket in list(websockets):
+                    websocket.write_frame(raw)
+                if self.held:
+                    self.release_local(channel, raw)
+                if not all(ws.is_writable() for ws in websockets):
+                    self.pause(channel)
+            else:
+                yield from self.push_back(channel, raw)
+
+    @asyncio.coroutine
+    def push_back(self, channel, raw):
+        """Put message received from inbox to channel queue, pushes
+        are counted per channel as [started, done], see :meth:`._resume`."""
+        counts = self.pushes.setdefault(channel, [0, 0])
+        counts[0] += 1
+        try:
+            yield from self.conn.lpush(channel, raw)
+        finally:
+            counts[1] += 1
+            if ((counts[0] == counts[1]) and (channel not in self.paused) and
+                    (self.pushes.get(channel) is counts)):
+                del self.pushes[channel]
+
+    def is_local_writable(self, channel):
+        """Paused channel messages go through Redis as well, so they
+        are not written before messages stored in channel queue."""
+        return ((channel not in self.paused) and
+                super().is_local_writable(channel))
+
+    def pause(self, channel):
+        """Store messages for channel in its queue until WebSockets
+        outgoing buffers are drained."""
+        self.paused.add(channel)
+        self.loop.create_task(self._resume(channel))
+
+    @asyncio.coroutine
+    def _resume(self, channel):
+        while True:
+            for websocket in list(self.sockets.get(channel, ())):
+                yield from websocket.wait_writable()
+            websockets = self.sockets.get(channel)
+            if not websockets:
+                break
+            # Pushes by inbox listener may land after popping, so queue
+            # is drained again unless no pushes were pending or started
+            counts = self.pushes.get(channel) or [0, 0]
+            idle, started = (counts[0] == counts[1]), counts[0]
+            # Pop chunk of the oldest messages from channel queue
+            tr = self.conn.multi_exec()
+            tr.lrange(channel, -self.RESUME_CHUNK, -1)
+            tr.ltrim(channel, 0, -self.RESUME_CHUNK - 1)
+            raw_messages, _ = yield from tr.execute()
+            for raw in reversed(raw_messages):
+                for websocket in websockets:
+                    websocket.write_frame(raw)
+                if self.held:
+                    self.release_local(channel, raw)
+            counts = self.pushes.get(channel) or [0, 0]
+            if ((len(raw_messages) < self.RESUME_CHUNK) and idle and
+                    (counts[0] == started)):
+                break
+        self.paused.discard(channel)
+        counts = self.pushes.get(channel)
+        if counts and (counts[0] == counts[1]):
+            del self.pushes[channel]
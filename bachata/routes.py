@@ -11,3 +11,22 @@ class DirectRoute(base.BaseRoute):
             # if websocket:
             #     message['from'] = websocket.get_channel()
             return message['dest']
+
+
+class GroupRoute(base.BaseRoute):
+    """Route messages to groups of channels.
+
+    Message with group name in ``key`` field is delivered to all group
+    members, groups are managed by messages queue, see
+    :meth:`.BaseQueue.add_group_members`.
+
+    :param key: Message field with group name, default is ``'group'``
+
+    """
+    def __init__(self, key='group'):
+        self.key = key
+
+    @asyncio.coroutine
+    def process(self, message, websocket=None, proto=None):
+        if self.key in message:
+            return base.Group(message[self.key])
@@ -3,6 +3,8 @@ import uuid
 import asyncio
 import websockets
 import logging
+import unittest
+import unittest.mock
 
 log = logging.getLogger(__name__)
 
@@ -16,26 +18,37 @@ if tornado:
     import tornado.web
     import tornado.testing
     import bachata
+    import bachata.proto
     import bachata.tornado
     import bachata.redis
+    import bachata.memory
 
     from tornado.ioloop import IOLoop
     IOLoop.configure('tornado.platform.asyncio.AsyncIOLoop')
 
 
+    REDIS_CONN_PARAMS = {'address': ('localhost', 6379), 'db': 9}
+
+
     class TestApp(tornado.web.Application):
-        def __init__(self, *args, **kwargs):
-            self.reliable = kwargs.pop('reliable', False)
-            self.io_loop = kwargs.pop('io_loop')
+        def __init__(self, handlers, io_loop=None, reliable=False,
+                     **queue_params):
+            self.reliable = reliable
+            self.io_loop = io_loop
+            self.queue_params = queue_params
             self.is_init = False
 
-            self.messages = bachata.redis.RedisMessagesCenter(
-                loop=self.io_loop.asyncio_loop,
-                conn_params={'address': ('localhost', 6379), 'db': 9},
-                reliable=self.reliable)
+            self.messages = self.create_messages()
             self.messages.add_route(bachata.DirectRoute())
+            self.messages.add_route(bachata.GroupRoute())
 
-            super().__init__(*args, **kwargs)
+            super().__init__(handlers)
+
+        def create_messages(self):
+            return bachata.redis.RedisMessagesCenter(
+                loop=self.io_loop.asyncio_loop,
+                conn_params=REDIS_CONN_PARAMS,
+                reliable=self.reliable, **self.queue_params)
 
         @asyncio.coroutine
         def init(self):
@@ -47,6 +60,306 @@ if tornado:
             yield from self.messages.done()
 
 
+    class MemoryTestApp(TestApp):
+        def create_messages(self):
+            return bachata.memory.MemoryMessagesCenter(
+                loop=self.io_loop.asyncio_loop,
+                reliable=self.reliable, **self.queue_params)
+
+
+    class JSONCodecTest(unittest.TestCase):
+        def test_explicit_codec(self):
+            codec = bachata.proto.JSONCodec()
+            proto = bachata.BaseProtocol(codec=codec)
+            self.assertIs(proto.codec, codec)
+
+        def test_codec_selection(self):
+            proto_module = bachata.proto
+            with unittest.mock.patch.multiple(proto_module, orjson=None,
+                                              ujson=None, rapidjson=None):
+                codec = proto_module.get_json_codec()
+                self.assertIsInstance(codec, proto_module.JSONCodec)
+                self.assertEqual(codec.name, 'json')
+
+            for name, codec_cls in (
+                    ('orjson', proto_module.OrjsonCodec),
+                    ('ujson', proto_module.UjsonCodec),
+                    ('rapidjson', proto_module.RapidjsonCodec)):
+                if getattr(proto_module, name):
+                    codec = proto_module.get_json_codec()
+                    self.assertIsInstance(codec, codec_cls)
+                    break
+
+        def test_codec_round_trip(self):
+            message = {'id': '1', 'type': 'test', 'data': {'text': 'hi'}}
+            codec = bachata.BaseProtocol().codec
+            raw = codec.dumps(message)
+            self.assertEqual(codec.loads(raw), message)
+
+            codec = bachata.proto.JSONCodec()
+            raw = codec.dumps(message)
+            self.assertEqual(codec.loads(raw.encode('utf-8')), message)
+
+
+    class TransportFramesTest(unittest.TestCase):
+        def test_transport_frame(self):
+            proto = bachata.BaseProtocol()
+            frame = proto.transport_frame(proto.TRANS_PONG)
+            self.assertEqual(proto.load_message(frame),
+                             {'type': proto.TRANS_PONG})
+
+            # cached per protocol instance
+            self.assertIs(proto.transport_frame(proto.TRANS_PONG), frame)
+            other = bachata.BaseProtocol(codec=bachata.proto.JSONCodec())
+            self.assertEqual(other.transport_frame(other.TRANS_PONG),
+                             json.dumps({'type': other.TRANS_PONG}))
+
+        def test_is_ping(self):
+            proto = bachata.BaseProtocol()
+            for raw in ('{"type":1001}', '{"type": 1001}',
+                        b'{"type":1001}', b'{"type": 1001}'):
+                self.assertTrue(proto.is_ping(raw))
+            for raw in ('{"type":1002}', '{"type":1001,"data":1}',
+                        '{"type": "1001"}', '', b'x' * 1000):
+                self.assertFalse(proto.is_ping(raw))
+
+
+    class DumpBatchTest(unittest.TestCase):
+        def test_json_batch(self):
+            proto = bachata.BaseProtocol()
+            messages = [{'id': '1', 'type': 'test'}, {'id': '2'}]
+            raw_messages = [json.dumps(messages[0]),
+                            json.dumps(messages[1]).encode('utf-8')]
+            batch = proto.dump_batch(raw_messages)
+            self.assertEqual(proto.load_message(batch), messages)
+
+        @unittest.skipIf(not bachata.proto.msgpack, "msgpack not installed")
+        def test_msgpack_batch(self):
+            proto = bachata.MsgPackProtocol()
+            # fixarray, array 16 and array 32 headers
+            for size in (1, 15, 16, 0xffff, 0x10000):
+                messages = [{'id': str(i)} for i in range(size)]
+                batch = proto.dump_batch(
+                    [proto.dump_message(m) for m in messages])
+                self.assertEqual(proto.load_message(batch), messages)
+
+
+    class MessageTest(unittest.TestCase):
+        RAW = '{"id": "1",  "type": 5, "data": {"text": "hi"}}'
+
+        def test_unchanged_dump(self):
+            proto = bachata.BaseProtocol()
+            message = proto.load_envelope(self.RAW)
+            self.assertEqual(message['data'], {'text': 'hi'})
+            self.assertIs(message.dump(proto), self.RAW)
+
+        def assertEncoded(self, message, proto):
+            raw = message.dump(proto)
+            self.assertNotEqual(raw, self.RAW)
+            self.assertEqual(proto.load_message(raw), message.copy())
+
+        def test_changed_dump(self):
+            proto = bachata.BaseProtocol()
+
+            message = proto.load_envelope(self.RAW)
+            message['type'] = 6
+            self.assertEncoded(message, proto)
+
+            message = proto.load_envelope(self.RAW)
+            del message['data']
+            self.assertEncoded(message, proto)
+
+            message = proto.load_envelope(self.RAW)
+            message['data']['text'] = 'bye'
+            self.assertIs(message.dump(proto), self.RAW)
+            message.mark_changed()
+            self.assertEncoded(message, proto)
+
+        def test_other_proto_dump(self):
+            proto = bachata.BaseProtocol()
+            message = proto.load_envelope(self.RAW)
+            other = bachata.BaseProtocol(codec=bachata.proto.JSONCodec())
+            raw = message.dump(other)
+            self.assertNotEqual(raw, self.RAW)
+            self.assertEqual(other.load_message(raw),
+                             proto.load_message(self.RAW))
+
+        @unittest.skipIf(not bachata.proto.msgpack, "msgpack not installed")
+        def test_msgpack_dump(self):
+            proto = bachata.BaseProtocol()
+            message = proto.load_envelope(self.RAW)
+            msgpack_proto = bachata.MsgPackProtocol()
+            raw = message.dump(msgpack_proto)
+            self.assertIsInstance(raw, bytes)
+            self.assertEqual(msgpack_proto.load_message(raw), message.copy())
+
+        def test_copy(self):
+            message = bachata.BaseProtocol().load_envelope(self.RAW)
+            fields = message.copy()
+            self.assertIs(type(fields), dict)
+            self.assertEqual(json.loads(json.dumps(fields)),
+                             json.loads(self.RAW))
+
+
+    class ConfirmationsTest(unittest.TestCase):
+        def test_forget_confirmations(self):
+            queue = bachata.memory.MemoryQueue()
+            phone, desktop = object(), object()
+            queue.sockets['ch'] = [phone, desktop]
+
+            self.assertEqual(
+                queue.confirm_delivered('ch', ['m1', 'm2'], phone), [])
+            self.assertEqual(
+                queue.confirm_delivered('ch', ['m3'], desktop), [])
+
+            # desktop closes, messages confirmed by phone are done
+            queue.sockets['ch'].remove(desktop)
+            self.assertEqual(
+                sorted(queue.forget_confirmations('ch', desktop)),
+                ['m1', 'm2'])
+            self.assertEqual(
+                queue.confirm_delivered('ch', ['m3'], phone), ['m3'])
+            self.assertFalse(queue.confirmations)
+
+        def test_forget_last_socket(self):
+            queue = bachata.memory.MemoryQueue()
+            phone, desktop = object(), object()
+            queue.sockets['ch'] = [phone, desktop]
+            queue.confirm_delivered('ch', ['m1'], phone)
+
+            queue.sockets.pop('ch')
+            self.assertEqual(queue.forget_confirmations('ch', desktop), [])
+            self.assertFalse(queue.confirmations)
+
+
+    class LocalDeliveryOrderTest(unittest.TestCase):
+        def test_hold_until_received(self):
+            queue = bachata.redis.RedisQueue(local_delivery=True)
+            ws = unittest.mock.Mock()
+            queue.sockets['ch'] = [ws]
+
+            # full buffer, message goes through Redis
+            ws.is_writable.return_value = False
+            self.assertEqual(queue.write_local(['ch'], '1'), ['ch'])
+
+            # buffer is drained, but message 1 is still in Redis
+            ws.is_writable.return_value = True
+            self.assertEqual(queue.write_local(['ch', 'other'], '2'),
+                             ['ch', 'other'])
+            ws.write_frame.assert_not_called()
+
+            # message 2 follows message 1, so it's the last one held
+            queue.release_local('ch', b'1')
+            self.assertFalse(queue.is_local_writable('ch'))
+            queue.release_local('ch', b'2')
+            self.assertTrue(queue.is_local_writable('ch'))
+            self.assertEqual(queue.write_local(['ch'], '3'), [])
+            ws.write_frame.assert_called_once_with('3')
+
+
+    class RecordRoute(bachata.BaseRoute):
+        def __init__(self, name, result=None, types=None, concurrent=False,
+                     events=None):
+            self.name = name
+            self.result = result
+            self.types = types
+            self.concurrent = concurrent
+            self.events = events if events is not None else []
+
+        @asyncio.coroutine
+        def process(self, message, websocket=None, proto=None):
+            self.events.append(('start', self.name))
+            yield from asyncio.sleep(0)
+            self.events.append(('end', self.name))
+            return self.result
+
+
+    class RoutesIndexTest(unittest.TestCase):
+        def setUp(self):
+            self.loop = asyncio.new_event_loop()
+            self.messages = bachata.BaseMessagesCenter(
+                loop=self.loop, queue=bachata.BaseQueue())
+
+        def tearDown(self):
+            self.loop.close()
+
+        def test_get_routes(self):
+            r1 = RecordRoute('r1')
+            r2 = RecordRoute('r2', types=('a',))
+            r3 = RecordRoute('r3')
+            r4 = RecordRoute('r4')
+            self.messages.add_route(r1)
+            self.messages.add_route(r2)
+            self.messages.add_route(r3, types=['b'])
+            self.messages.add_route(r4)
+
+            self.assertEqual(self.messages.get_routes('a'), (r1, r2, r4))
+            self.assertEqual(self.messages.get_routes('b'), (r1, r3, r4))
+            self.assertEqual(self.messages.get_routes('c'), (r1, r4))
+            self.assertEqual(self.messages.get_routes(None), (r1, r4))
+
+            # unhashable type
+            self.assertEqual(self.messages.get_routes(['a']), (r1, r4))
+
+            # cached chain is reset on routes change
+            self.assertIs(self.messages.get_routes('a'),
+                          self.messages.get_routes('a'))
+            self.messages.del_route(r2)
+            self.assertEqual(self.messages.get_routes('a'), (r1, r4))
+
+
+    class ProcessRoutesTest(unittest.TestCase):
+        def setUp(self):
+            self.loop = asyncio.new_event_loop()
+            self.messages = bachata.BaseMessagesCenter(
+                loop=self.loop, queue=bachata.BaseQueue())
+
+        def tearDown(self):
+            self.loop.close()
+
+        def process_routes(self, message):
+            return self.loop.run_until_complete(
+                self.messages.process_routes(message))
+
+        def test_concurrent_routes(self):
+            events = []
+            r1 = RecordRoute('r1', 'ch1', concurrent=True, events=events)
+            r2 = RecordRoute('r2', ['ch2', 'ch3'], concurrent=True,
+                             events=events)
+            r3 = RecordRoute('r3', bachata.Group('g'), events=events)
+            r4 = RecordRoute('r4', concurrent=True, events=events)
+            for route in (r1, r2, r3, r4):
+                self.messages.add_route(route)
+
+            destinations = self.process_routes({'type': 'test'})
+            self.assertEqual(destinations, [
+                (r1, 'ch1'), (r2, 'ch2'), (r2, 'ch3'),
+                (r3, bachata.Group('g'))])
+
+            # adjacent concurrent routes are started together
+            self.assertEqual(events[:2], [('start', 'r1'), ('start', 'r2')])
+            self.assertEqual(events[4:], [
+                ('start', 'r3'), ('end', 'r3'),
+                ('start', 'r4'), ('end', 'r4')])
+
+        def test_concurrent_routes_stop(self):
+            events = []
+            r1 = RecordRoute('r1', 'ch1', concurrent=True, events=events)
+            r2 = RecordRoute('r2', True, concurrent=True, events=events)
+            r3 = RecordRoute('r3', 'ch3', concurrent=True, events=events)
+            r4 = RecordRoute('r4', 'ch4', events=events)
+            for route in (r1, r2, r3, r4):
+                self.messages.add_route(route)
+
+            destinations = self.process_routes({'type': 'test'})
+            self.assertEqual(destinations, [(r1, 'ch1')])
+
+            # next concurrent route is processed, but result is ignored,
+            # and next chunk is not processed at all
+            self.assertIn(('end', 'r3'), events)
+            self.assertNotIn(('start', 'r4'), events)
+
+
     class MessagesTestWebSocket(bachata.tornado.MessagesHandler):
         def get_channel(self):
             if not hasattr(self, '_channel'):
@@ -62,24 +375,43 @@ if tornado:
             log.debug("Connection closed")
 
 
+    class GatedInboxWebSocket(MessagesTestWebSocket):
+        inbox_size = 2
+
+        @property
+        def inbox_overflow(self):
+            return self.get_argument('overflow')
+
+        @asyncio.coroutine
+        def process_inbox(self):
+            # inbox is filled up until test opens the gate
+            yield from self.application.inbox_gate.wait()
+            yield from super().process_inbox()
+
+
     class BaseTornadoTest(tornado.testing.AsyncHTTPTestCase):
         @property
         def loop(self):
             return self.io_loop.asyncio_loop
 
+        app_cls = TestApp
+
+        app_params = {}
+
+        handler_cls = MessagesTestWebSocket
+
         def get_app(self):
-            if not hasattr(self, '_app'):
-                self._app = TestApp([
-                    ('/messages', MessagesTestWebSocket),
-                ], io_loop=self.io_loop)
-            return self._app
+            return self.app_cls([
+                ('/messages', self.handler_cls),
+            ], io_loop=self.io_loop, **self.app_params)
 
         def get_ws_url(self, url):
             return self.get_url(url).replace('http://', 'ws://')
 
         @asyncio.coroutine
-        def connect(self, ws_url):
-            return (yield from websockets.connect(ws_url, loop=self.loop))
+        def connect(self, ws_url, **params):
+            return (yield from websockets.connect(
+                ws_url, loop=self.loop, **params))
 
         def async(self, coroutine):
             def stop_with_error(exc):
@@ -159,11 +491,120 @@ if tornado:
             self.async(test())
 
 
+        def test_batch_messages(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_url = self.get_ws_url('/messages?channel=%s' % ch1)
+            ws2_url = self.get_ws_url('/messages?channel=%s' % ch2)
+
+            @asyncio.coroutine
+            def test():
+                ws1_conn = yield from self.connect(ws1_url)
+                yield from ws1_conn.recv()
+
+                ws2_conn = yield from self.connect(ws2_url)
+                yield from ws2_conn.recv()
+
+                # accept batches
+                yield from ws2_conn.send(json.dumps({'type': 1003}))
+                yield from asyncio.sleep(0.1, loop=self.loop)
+
+                # send
+                ids = [str(uuid.uuid4()) for _ in range(3)]
+                for msg_id in ids:
+                    msg = json.dumps({'type': 'test', 'dest': ch2, 'id': msg_id})
+                    yield from ws1_conn.send(msg)
+
+                # receive, messages may come in batches
+                received = []
+                while len(received) < len(ids):
+                    resp = json.loads((yield from ws2_conn.recv()))
+                    if isinstance(resp, list):
+                        received.extend(m['id'] for m in resp)
+                    else:
+                        received.append(resp['id'])
+                self.assertEqual(received, ids)
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+        def test_multi_device_message(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_url = self.get_ws_url('/messages?channel=%s' % ch1)
+            ws2_url = self.get_ws_url('/messages?channel=%s' % ch2)
+
+            @asyncio.coroutine
+            def test():
+                ws1_conn = yield from self.connect(ws1_url)
+                yield from ws1_conn.recv()
+
+                # two devices for the same channel
+                ws2_conns = []
+                for _ in range(2):
+                    conn = yield from self.connect(ws2_url)
+                    yield from conn.recv()
+                    ws2_conns.append(conn)
+                yield from asyncio.sleep(0.1, loop=self.loop)
+
+                # send
+                msg = json.dumps({'type': 'test', 'dest': ch2, 'id': str(uuid.uuid4())})
+                yield from ws1_conn.send(msg)
+
+                # every device receives
+                for conn in ws2_conns:
+                    resp = yield from conn.recv()
+                    self.assertEqual(json.loads(resp)['type'], 'test')
+
+                # close
+                yield from ws1_conn.close()
+                for conn in ws2_conns:
+                    yield from conn.close()
+
+            self.async(test())
+
+        def test_group_message(self):
+            ch1 = str(uuid.uuid4())
+            members = [str(uuid.uuid4()) for _ in range(3)]
+            group = str(uuid.uuid4())
+
+            @asyncio.coroutine
+            def test():
+                yield from self._app.messages.queue.add_group_members(
+                    group, members)
+
+                ws1_conn = yield from self.connect(
+                    self.get_ws_url('/messages?channel=%s' % ch1))
+                yield from ws1_conn.recv()
+
+                conns = []
+                for ch in members:
+                    conn = yield from self.connect(
+                        self.get_ws_url('/messages?channel=%s' % ch))
+                    yield from conn.recv()
+                    conns.append(conn)
+
+                # send
+                msg = json.dumps({'type': 'test', 'group': group, 'id': str(uuid.uuid4())})
+                yield from ws1_conn.send(msg)
+
+                # receive
+                for conn in conns:
+                    resp = yield from conn.recv()
+                    self.assertEqual(json.loads(resp)['type'], 'test')
+
+                # close
+                yield from ws1_conn.close()
+                for conn in conns:
+                    yield from conn.close()
+
+            self.async(test())
+
+
     class WebSocketReliableTest(BaseTornadoTest):
-        def get_app(self):
-            return TestApp([
-                ('/messages', MessagesTestWebSocket),
-            ], io_loop=self.io_loop, reliable=True)
+        app_params = {'reliable': True}
 
         def test_ws_connection(self):
             ws_url = self.get_ws_url('/messages?channel=%s' % str(uuid.uuid4()))
@@ -229,3 +670,386 @@ if tornado:
                 yield from ws2_conn.close()
 
             self.async(test())
+
+        def test_batch_delivery_confirm(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_url = self.get_ws_url('/messages?channel=%s' % ch1)
+            ws2_url = self.get_ws_url('/messages?channel=%s' % ch2)
+
+            @asyncio.coroutine
+            def test():
+                ws1_conn = yield from self.connect(ws1_url)
+                yield from ws1_conn.recv()
+
+                ws2_conn = yield from self.connect(ws2_url)
+                yield from ws2_conn.recv()
+
+                # send two messages
+                ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+                for msg_id in ids:
+                    msg = json.dumps({'type': 'test', 'dest': ch2, 'id': msg_id})
+                    yield from ws1_conn.send(msg)
+                    confirm1 = yield from ws1_conn.recv()
+                    self.assertEqual(json.loads(confirm1)['type'], 100)
+
+                # receive both
+                received = []
+                for _ in ids:
+                    resp = yield from ws2_conn.recv()
+                    received.append(json.loads(resp)['id'])
+                self.assertEqual(sorted(received), sorted(ids))
+
+                # receive - confirm all at once
+                confirm2 = json.dumps({'type': 200, 'data': received})
+                yield from ws2_conn.send(confirm2)
+
+                # delivery - confirm with list of IDs
+                delivery = yield from ws1_conn.recv()
+                delivery_msg = json.loads(delivery)
+                self.assertEqual(delivery_msg['type'], 300)
+                self.assertEqual(sorted(delivery_msg['data']), sorted(ids))
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+
+    class WebSocketMemoryTest(WebSocketConnTest):
+        app_cls = MemoryTestApp
+
+
+    class WebSocketReliableMemoryTest(WebSocketReliableTest):
+        app_cls = MemoryTestApp
+
+
+    @unittest.skipIf(not bachata.proto.msgpack, "msgpack not installed")
+    class WebSocketMsgPackTest(BaseTornadoTest):
+        def get_app(self):
+            app = super().get_app()
+            app.messages.add_protocol(bachata.MsgPackProtocol())
+            return app
+
+        def test_msgpack_to_json(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            msgpack_proto = bachata.MsgPackProtocol()
+
+            @asyncio.coroutine
+            def recv_test(ws_conn, load):
+                while True:
+                    resp = yield from ws_conn.recv()
+                    message = load(resp)
+                    if message['type'] == 'test':
+                        return message
+
+            @asyncio.coroutine
+            def test():
+                ws1_conn = yield from self.connect(
+                    self.get_ws_url('/messages?channel=%s' % ch1),
+                    subprotocols=['bachata.msgpack'])
+                self.assertEqual(ws1_conn.subprotocol, 'bachata.msgpack')
+                conn_ok = yield from ws1_conn.recv()
+                self.assertIsInstance(conn_ok, bytes)
+                self.assertEqual(msgpack_proto.load_message(conn_ok)['type'],
+                                 1000)
+
+                ws2_conn = yield from self.connect(
+                    self.get_ws_url('/messages?channel=%s' % ch2))
+                self.assertIsNone(ws2_conn.subprotocol)
+                yield from ws2_conn.recv()
+
+                # msgpack => JSON
+                yield from ws1_conn.send(msgpack_proto.dump_message(
+                    {'type': 'test', 'dest': ch2, 'id': str(uuid.uuid4()),
+                     'data': {'text': 'hi'}}))
+                resp = yield from recv_test(ws2_conn, json.loads)
+                self.assertEqual(resp['data'], {'text': 'hi'})
+
+                # JSON => msgpack
+                yield from ws2_conn.send(json.dumps(
+                    {'type': 'test', 'dest': ch1, 'id': str(uuid.uuid4()),
+                     'data': {'text': 'bye'}}))
+
+                def load_binary(raw):
+                    self.assertIsInstance(raw, bytes)
+                    return msgpack_proto.load_message(raw)
+
+                resp = yield from recv_test(ws1_conn, load_binary)
+                self.assertEqual(resp['data'], {'text': 'bye'})
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+
+    class WebSocketInboxTest(BaseTornadoTest):
+        app_cls = MemoryTestApp
+
+        handler_cls = GatedInboxWebSocket
+
+        @asyncio.coroutine
+        def fill_inbox(self, overflow):
+            """Connect sender with closed inbox gate and receiver, send
+            2 messages fitting to inbox and 2 more overflowing it."""
+            self._app.inbox_gate = asyncio.Event(loop=self.loop)
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_conn = yield from self.connect(self.get_ws_url(
+                '/messages?channel=%s&overflow=%s' % (ch1, overflow)))
+            yield from ws1_conn.recv()
+            ws2_conn = yield from self.connect(self.get_ws_url(
+                '/messages?channel=%s&overflow=drop' % ch2))
+            yield from ws2_conn.recv()
+
+            for i in range(3):
+                yield from ws1_conn.send(json.dumps(
+                    {'type': 'test', 'dest': ch2, 'id': 'm%s' % i}))
+            # valid frame, but not message object
+            yield from ws1_conn.send(json.dumps([{'type': 'test'}]))
+            return ws1_conn, ws2_conn
+
+        @asyncio.coroutine
+        def recv_ids(self, ws_conn, count):
+            ids = []
+            for _ in range(count):
+                resp = yield from ws_conn.recv()
+                ids.append(json.loads(resp)['id'])
+            return ids
+
+        def test_overflow_drop(self):
+            @asyncio.coroutine
+            def test():
+                ws1_conn, ws2_conn = yield from self.fill_inbox('drop')
+
+                # ping is answered right away, nothing is written before
+                yield from ws1_conn.send(json.dumps({'type': 1001}))
+                resp = yield from ws1_conn.recv()
+                self.assertEqual(json.loads(resp)['type'], 1002)
+
+                # inbox is processed in order, overflowed messages are lost
+                self._app.inbox_gate.set()
+                ids = yield from self.recv_ids(ws2_conn, 2)
+                self.assertEqual(ids, ['m0', 'm1'])
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+        def test_overflow_reject(self):
+            @asyncio.coroutine
+            def test():
+                ws1_conn, ws2_conn = yield from self.fill_inbox('reject')
+
+                for rejected in ({'type': 400, 'data': 'm2'},
+                                 {'type': 400}):
+                    resp = yield from ws1_conn.recv()
+                    self.assertEqual(json.loads(resp), rejected)
+
+                self._app.inbox_gate.set()
+                ids = yield from self.recv_ids(ws2_conn, 2)
+                self.assertEqual(ids, ['m0', 'm1'])
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+        def test_overflow_close(self):
+            @asyncio.coroutine
+            def test():
+                ws1_conn, ws2_conn = yield from self.fill_inbox('close')
+
+                with self.assertRaises(websockets.ConnectionClosed):
+                    while True:
+                        yield from ws1_conn.recv()
+                self.assertEqual(ws1_conn.close_code, 1008)
+
+                # messages accepted to inbox are still processed
+                self._app.inbox_gate.set()
+                ids = yield from self.recv_ids(ws2_conn, 2)
+                self.assertEqual(ids, ['m0', 'm1'])
+
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+
+    class WebSocketNodeInboxTest(WebSocketConnTest):
+        app_params = {'node_inbox': True}
+
+
+    class WebSocketStreamTest(WebSocketReliableTest):
+        app_params = {'streams': True, 'stream_expire': 60}
+
+
+    class WebSocketListenerTest(WebSocketConnTest):
+        app_params = {'listener_conns': 2}
+
+
+    class WebSocketReliableListenerTest(WebSocketReliableTest):
+        app_params = {'reliable': True, 'listener_conns': 2}
+
+
+    class WebSocketStreamListenerTest(WebSocketReliableTest):
+        app_params = {'streams': True, 'stream_expire': 60,
+                      'listener_conns': 2}
+
+
+    class WebSocketLocalDeliveryTest(WebSocketConnTest):
+        app_params = {'local_delivery': True}
+
+
+    class WebSocketReliableLocalDeliveryTest(WebSocketReliableTest):
+        app_params = {'reliable': True, 'local_delivery': True}
+
+
+    class WebSocketSharedBodiesTest(WebSocketReliableTest):
+        app_params = {'reliable': True, 'shared_bodies': True}
+
+        @asyncio.coroutine
+        def get_body_keys(self):
+            keys = yield from self._app.messages.queue.conn.keys(
+                'bachata:body:*')
+            return set(keys)
+
+        def test_body_refs(self):
+            ch1 = str(uuid.uuid4())
+            direct = [str(uuid.uuid4()) for _ in range(2)]
+            members = [str(uuid.uuid4()) for _ in range(2)]
+            group = str(uuid.uuid4())
+
+            @asyncio.coroutine
+            def test():
+                yield from self._app.messages.queue.add_group_members(
+                    group, members)
+                body_keys = yield from self.get_body_keys()
+
+                ws1_conn = yield from self.connect(
+                    self.get_ws_url('/messages?channel=%s' % ch1))
+                yield from ws1_conn.recv()
+
+                conns = []
+                for ch in direct + members:
+                    conn = yield from self.connect(
+                        self.get_ws_url('/messages?channel=%s' % ch))
+                    yield from conn.recv()
+                    conns.append(conn)
+
+                # send to multiple channels and to group
+                yield from ws1_conn.send(json.dumps(
+                    {'type': 'test', 'dest': direct, 'id': 'direct'}))
+                yield from ws1_conn.send(json.dumps(
+                    {'type': 'test', 'group': group, 'id': 'group'}))
+
+                received = []
+                for conn in conns:
+                    resp = yield from conn.recv()
+                    received.append(json.loads(resp)['id'])
+                self.assertEqual(received, ['direct'] * 2 + ['group'] * 2)
+
+                # single body per message
+                new_keys = yield from self.get_body_keys()
+                self.assertEqual(len(new_keys - body_keys), 2)
+
+                # receive - confirm from every recipient
+                for conn, message_id in zip(conns, received):
+                    yield from conn.send(
+                        json.dumps({'type': 200, 'data': message_id}))
+
+                delivered = 0
+                while delivered < len(conns):
+                    resp = yield from ws1_conn.recv()
+                    if json.loads(resp)['type'] == 300:
+                        delivered += 1
+
+                # bodies are removed with the last reference
+                new_keys = yield from self.get_body_keys()
+                self.assertEqual(new_keys - body_keys, set())
+
+                yield from ws1_conn.close()
+                for conn in conns:
+                    yield from conn.close()
+
+            self.async(test())
+
+
+    class WebSocketPubSubTest(WebSocketConnTest):
+        app_params = {'pubsub_types': ('typing',)}
+
+        def test_ephemeral_message(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_url = self.get_ws_url('/messages?channel=%s' % ch1)
+            ws2_url = self.get_ws_url('/messages?channel=%s' % ch2)
+
+            @asyncio.coroutine
+            def test():
+                ws1_conn = yield from self.connect(ws1_url)
+                yield from ws1_conn.recv()
+
+                ws2_conn = yield from self.connect(ws2_url)
+                yield from ws2_conn.recv()
+
+                # wait for channel subscription
+                yield from asyncio.sleep(0.1, loop=self.loop)
+
+                # send ephemeral and then regular message
+                msg = json.dumps({'type': 'typing', 'dest': ch2})
+                yield from ws1_conn.send(msg)
+                msg = json.dumps({'type': 'test', 'dest': ch2})
+                yield from ws1_conn.send(msg)
+
+                # receive both
+                received = []
+                for _ in range(2):
+                    resp = yield from ws2_conn.recv()
+                    received.append(json.loads(resp)['type'])
+                self.assertEqual(sorted(received), ['test', 'typing'])
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+
+        def test_ephemeral_message_after_reconnect(self):
+            ch1 = str(uuid.uuid4())
+            ch2 = str(uuid.uuid4())
+            ws1_url = self.get_ws_url('/messages?channel=%s' % ch1)
+            ws2_url = self.get_ws_url('/messages?channel=%s' % ch2)
+
+            @asyncio.coroutine
+            def test():
+                # the only channel of process is unsubscribed on close
+                ws2_conn = yield from self.connect(ws2_url)
+                yield from ws2_conn.recv()
+                yield from ws2_conn.close()
+                yield from asyncio.sleep(0.1, loop=self.loop)
+
+                ws1_conn = yield from self.connect(ws1_url)
+                yield from ws1_conn.recv()
+
+                ws2_conn = yield from self.connect(ws2_url)
+                yield from ws2_conn.recv()
+
+                # wait for channel subscription
+                yield from asyncio.sleep(0.1, loop=self.loop)
+
+                msg = json.dumps({'type': 'typing', 'dest': ch2})
+                yield from ws1_conn.send(msg)
+
+                resp = yield from ws2_conn.recv()
+                self.assertEqual(json.loads(resp)['type'], 'typing')
+
+                yield from ws1_conn.close()
+                yield from ws2_conn.close()
+
+            self.async(test())
+
+
+    class WebSocketReliablePubSubTest(WebSocketReliableTest):
+        app_params = {'reliable': True, 'pubsub_types': ('typing',)}
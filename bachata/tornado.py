@@ -2,10 +2,13 @@
 import json
 import asyncio
 import logging
+import collections
 import tornado.gen
 import tornado.websocket
 import tornado.ioloop
 
+log = logging.getLogger(__name__)
+
 
 class MessagesHandler(tornado.websocket.WebSocketHandler):
     """Base WebSocket handler for Tornado.
@@ -16,12 +19,210 @@ class MessagesHandler(tornado.websocket.WebSocketHandler):
     Redefine :meth:`.get_channel` in subclass if you want to have
     channels identifiers based on authenticated user.
 
+    Messages batching is enabled by client with type 1003 transport
+    message, then messages written within :attr:`.batch_delay` seconds
+    (or within the same event loop iteration, by default) are sent as
+    single array frame. Batch is sent right away when it reaches
+    :attr:`.batch_max_count` messages or :attr:`.batch_max_size` bytes.
+
+    Outgoing data not yet written to network is tracked, and when it
+    exceeds :attr:`.max_buffer_size` bytes, queue listeners stop popping
+    messages for connection until buffer is drained, see
+    :meth:`.wait_writable`. Connection stalled for too long is closed,
+    see :meth:`.is_slow_consumer`.
+
+    Incoming messages are put on connection inbox and processed one by
+    one in the order they are received. Inbox is bounded by
+    :attr:`.inbox_size` and on overflow :attr:`.inbox_overflow` policy
+    is applied:
+
+    - ``'drop'``: message is dropped
+    - ``'reject'``: message is dropped and sender is notified with
+      type 400 transport message
+    - ``'close'``: connection is closed
+
     """
+    proto = None
+
+    inbox_size = 100
+
+    inbox_overflow = 'drop'
+
+    _inbox = None
+
+    max_buffer_size = 1048576
+
+    slow_consumer_timeout = 60
+
+    slow_check_interval = 5
+
+    buffered_size = 0
+
+    _drained = None
+
+    batch_delay = 0
+
+    batch_max_count = 100
+
+    batch_max_size = 65536
+
+    _batch = None
+
     @property
     def loop(self):
         io_loop = tornado.ioloop.IOLoop.current()
         return io_loop.asyncio_loop
 
+    def select_subprotocol(self, subprotocols):
+        """Select messages protocol by WebSocket subprotocol names
+        requested by client, see :meth:`.BaseMessagesCenter.add_protocol`.
+
+        Main messages center protocol is used if none of requested
+        subprotocols is supported.
+
+        """
+        mc = self.get_messages_center()
+        for name in subprotocols:
+            if name in mc.protocols:
+                self.proto = mc.protocols[name]
+                return name
+        self.proto = mc.proto
+
+    def write_frame(self, raw_message):
+        """Write message dump from queue, it's recoded to connection
+        protocol if necessary and written as text or binary frame.
+
+        :param raw_message: Message dump in main messages center protocol
+
+        """
+        mc = self.get_messages_center()
+        proto = mc.get_proto(self)
+        self._write_frame(mc.recode(raw_message, proto), proto)
+
+    def write_transport(self, message_type):
+        """Write constant transport message without data, i.e. "ready"
+        or "pong", it's written as pre-encoded frame in connection
+        protocol, see :meth:`.BaseProtocol.transport_frame`.
+
+        :param message_type: Transport message type
+
+        """
+        proto = self.get_messages_center().get_proto(self)
+        self._write_frame(proto.transport_frame(message_type), proto)
+
+    def _write_frame(self, raw_message, proto):
+        """Write message dump in connection protocol, messages are
+        batched if batching is enabled. Frames for closed connection
+        are skipped, so writing to channel WebSockets never fails."""
+        if self.ws_connection is None:
+            return
+
+        if self._batch is None:
+            self._write_buffered(raw_message, proto.binary)
+            return
+
+        self._batch.append(raw_message)
+        self._batch_size += len(raw_message)
+        if ((len(self._batch) >= self.batch_max_count) or
+                (self._batch_size >= self.batch_max_size)):
+            self.flush_frames()
+        elif self._batch_handle is None:
+            if self.batch_delay:
+                self._batch_handle = self.loop.call_later(
+                    self.batch_delay, self.flush_frames)
+            else:
+                self._batch_handle = self.loop.call_soon(self.flush_frames)
+
+    def start_batching(self):
+        """Enable sending messages batches, see :meth:`.write_frame`."""
+        if self._batch is None:
+            self._batch = []
+            self._batch_size = 0
+            self._batch_handle = None
+
+    def flush_frames(self):
+        """Send messages batch, single message is sent as is."""
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+
+        frames = self._batch
+        if not frames or (self.ws_connection is None):
+            return
+        self._batch = []
+        self._batch_size = 0
+
+        proto = self.get_messages_center().get_proto(self)
+        if len(frames) == 1:
+            frame = frames[0]
+        else:
+            frame = proto.dump_batch(frames)
+        self._write_buffered(frame, proto.binary)
+
+    def _write_buffered(self, frame, binary):
+        """Write frame and track it until it's flushed to network."""
+        size = len(frame)
+        try:
+            future = self.write_message(frame, binary=binary)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        if future is not None:
+            self.buffered_size += size
+            future.add_done_callback(lambda _: self._on_flushed(size))
+
+    def _on_flushed(self, size):
+        self.buffered_size -= size
+        if (self._drained is not None and
+                self.buffered_size < self.max_buffer_size):
+            self._drained.set()
+
+    def is_writable(self):
+        """Check if outgoing buffer is below :attr:`.max_buffer_size`."""
+        return self.buffered_size < self.max_buffer_size
+
+    @asyncio.coroutine
+    def wait_writable(self):
+        """Wait until outgoing buffer is below :attr:`.max_buffer_size`,
+        asyncio coroutine.
+
+        While waiting, :meth:`.is_slow_consumer` is checked every
+        :attr:`.slow_check_interval` seconds and connection is closed
+        if it returns ``True``.
+
+        :return: ``False`` if connection is closed
+
+        """
+        started = None
+        while not self.is_writable():
+            if self.ws_connection is None:
+                return False
+            if started is None:
+                started = self.loop.time()
+            if self._drained is None:
+                self._drained = asyncio.Event(loop=self.loop)
+            self._drained.clear()
+            try:
+                yield from asyncio.wait_for(self._drained.wait(),
+                                            self.slow_check_interval,
+                                            loop=self.loop)
+            except asyncio.TimeoutError:
+                if self.is_slow_consumer(self.loop.time() - started):
+                    self.close(code=1008, reason="Error: slow consumer")
+                    return False
+        return self.ws_connection is not None
+
+    def is_slow_consumer(self, stalled_time):
+        """Decide if connection should be closed as slow consumer.
+
+        Default implementation returns ``True`` if outgoing buffer
+        stays full for :attr:`.slow_consumer_timeout` seconds.
+
+        :param stalled_time: Time in seconds since buffer is full
+
+        """
+        return (self.slow_consumer_timeout is not None and
+                stalled_time >= self.slow_consumer_timeout)
+
     def open(self):
         """Open WebSocket connection and add socket channel to messages center.
 
@@ -56,17 +257,80 @@ class MessagesHandler(tornado.websocket.WebSocketHandler):
 
     def on_close(self):
         """Remove handler from messages center."""
+        if self._inbox is not None:
+            self._inbox_closed = True
+            self._inbox_ready.set()
+        if self._batch is not None:
+            if self._batch_handle is not None:
+                self._batch_handle.cancel()
+            self._batch = None
         self.get_messages_center().del_socket(self.get_channel(), self)
 
     def on_message(self, raw_message):
-        """Process message to messages center.
+        """Put message on connection inbox for processing to messages
+        center, inbox processing task is started on first message.
+
+        Raw message is passed as is, protocol codec accepts both
+        str and bytes. Common "ping" messages are recognized without
+        loading and responded right away, see
+        :meth:`.BaseProtocol.is_ping`.
         """
-        if isinstance(raw_message, bytes):
-            str_message = raw_message.decode('utf-8')
-        else:
-            str_message = raw_message
-        self.loop.create_task(
-            self.get_messages_center().process(str_message, self))
+        proto = self.get_messages_center().get_proto(self)
+        if proto.is_ping(raw_message):
+            self.write_transport(proto.TRANS_PONG)
+            return
+
+        if self._inbox is None:
+            self._inbox = collections.deque()
+            self._inbox_ready = asyncio.Event(loop=self.loop)
+            self._inbox_closed = False
+            self.loop.create_task(self.process_inbox())
+
+        if len(self._inbox) >= self.inbox_size:
+            self.on_inbox_overflow(raw_message)
+            return
+
+        self._inbox.append(raw_message)
+        self._inbox_ready.set()
+
+    @asyncio.coroutine
+    def process_inbox(self):
+        """Process inbox messages to messages center one by one,
+        until connection is closed and inbox is empty."""
+        mc = self.get_messages_center()
+        while True:
+            while self._inbox:
+                raw_message = self._inbox.popleft()
+                try:
+                    yield from mc.process(raw_message, self)
+                except Exception:
+                    log.exception("Error processing message")
+            if self._inbox_closed:
+                return
+            self._inbox_ready.clear()
+            yield from self._inbox_ready.wait()
+
+    def on_inbox_overflow(self, raw_message):
+        """Apply :attr:`.inbox_overflow` policy to message which
+        doesn't fit to inbox."""
+        log.warning("Inbox overflow for %s, policy: %s" %
+                    (self.get_channel(), self.inbox_overflow))
+        if self.inbox_overflow == 'close':
+            self.close(code=1008, reason="Error: too many messages")
+        elif self.inbox_overflow == 'reject':
+            proto = self.get_messages_center().get_proto(self)
+            try:
+                message = proto.load_message(raw_message)
+            except ValueError:
+                message = None
+            # Valid frame is not necessarily an object, i.e. batch array
+            if isinstance(message, dict):
+                message_id = message.get('id')
+            else:
+                message_id = None
+            rejected = proto.make_message(
+                type=proto.TRANS_REJECTED, data=message_id)
+            self.write_frame(proto.dump_message(rejected))
 
     def on_auth_error(self):
         """Close connection on authorization error."""
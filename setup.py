@@ -10,8 +10,9 @@ Overview
 - Requires Tornado running on asyncio event loop
 - Implements simple messages queue on Redis LPUSH / BRPOP
 - Implements reliable messages delivery on Redis BRPOPLPUSH pattern
-- JSON messages format
-- Custom messages routing
+- Implements in-process memory queue for single node deployments
+- JSON messages format, optional MessagePack format
+- Custom messages routing, groups fan-out
 
 """
 from setuptools import setup
@@ -33,10 +34,13 @@ setup(
     license='Apache',
     zip_safe=False,
     install_requires=[
-        'tornado>=4.2.1',
-        'aioredis>=0.2.3',
+        'tornado>=4.3',
+        'aioredis>=1.0',
         'websockets>=2.6',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+    },
     packages=[
         'bachata',
     ],